@@ -3,15 +3,122 @@
 
 -- 创建 tasks 表
 CREATE TABLE IF NOT EXISTS tasks (
-    id SERIAL PRIMARY KEY,
+    id BIGSERIAL PRIMARY KEY,
     title VARCHAR(255) NOT NULL,
     description TEXT,
     priority INTEGER NOT NULL DEFAULT 3 CHECK (priority BETWEEN 1 AND 5),
     is_completed BOOLEAN NOT NULL DEFAULT FALSE,
     due_date TIMESTAMPTZ,
     created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    completed_at TIMESTAMPTZ
+    completed_at TIMESTAMPTZ,
+    estimated_hours REAL CHECK (estimated_hours >= 0),
+    tenant_id TEXT NOT NULL DEFAULT 'default',
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
 );
+CREATE INDEX IF NOT EXISTS idx_tasks_tenant_due ON tasks (tenant_id, due_date);
+CREATE INDEX IF NOT EXISTS idx_tasks_tenant_week
+    ON tasks (tenant_id, COALESCE(due_date, created_at));
+CREATE INDEX IF NOT EXISTS idx_tasks_tenant_updated ON tasks (tenant_id, updated_at);
+
+-- 创建 task_deletions 表及变更跟踪触发器（训练快照补充增量用）
+CREATE TABLE IF NOT EXISTS task_deletions (
+    task_id BIGINT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+CREATE INDEX IF NOT EXISTS idx_task_deletions_tenant
+    ON task_deletions (tenant_id, deleted_at);
+CREATE OR REPLACE FUNCTION track_task_changes() RETURNS trigger AS $fn$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO task_deletions (task_id, tenant_id) VALUES (OLD.id, OLD.tenant_id);
+        RETURN OLD;
+    END IF;
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END
+$fn$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS tasks_track_changes ON tasks;
+CREATE TRIGGER tasks_track_changes
+    BEFORE INSERT OR UPDATE OR DELETE ON tasks
+    FOR EACH ROW EXECUTE FUNCTION track_task_changes();
+
+-- 创建 task_dependencies 表（task_id 依赖 depends_on_id）
+CREATE TABLE IF NOT EXISTS task_dependencies (
+    task_id BIGINT NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+    depends_on_id BIGINT NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+    PRIMARY KEY (task_id, depends_on_id),
+    CHECK (task_id <> depends_on_id)
+);
+CREATE INDEX IF NOT EXISTS idx_task_dependencies_depends_on
+    ON task_dependencies (depends_on_id);
+
+-- 创建 task_dependency_versions 表（依赖增删时按租户递增，判断缓存的依赖图是否过期）
+CREATE TABLE IF NOT EXISTS task_dependency_versions (
+    tenant_id TEXT PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+CREATE OR REPLACE FUNCTION bump_dependency_version() RETURNS trigger AS $fn$
+DECLARE
+    changed BIGINT := CASE WHEN TG_OP = 'DELETE' THEN OLD.task_id ELSE NEW.task_id END;
+BEGIN
+    INSERT INTO task_dependency_versions (tenant_id, version)
+    SELECT tenant_id, 1 FROM tasks WHERE id = changed
+    ON CONFLICT (tenant_id)
+        DO UPDATE SET version = task_dependency_versions.version + 1;
+    RETURN NULL;
+END
+$fn$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS task_dependencies_bump_version ON task_dependencies;
+CREATE TRIGGER task_dependencies_bump_version
+    AFTER INSERT OR DELETE ON task_dependencies
+    FOR EACH ROW EXECUTE FUNCTION bump_dependency_version();
+
+-- 创建 report_weekly_stats 表（统计报表缓存：已结束的周按租户、优先级聚合）
+CREATE TABLE IF NOT EXISTS report_weekly_stats (
+    tenant_id TEXT NOT NULL,
+    week_start TIMESTAMPTZ NOT NULL,
+    priority INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    labeled INTEGER NOT NULL,
+    on_time INTEGER NOT NULL,
+    late INTEGER NOT NULL,
+    lateness_hours DOUBLE PRECISION NOT NULL,
+    feature_rows INTEGER NOT NULL,
+    feature_success INTEGER NOT NULL,
+    hours_available_sum DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (tenant_id, week_start, priority)
+);
+
+-- 任务变化（新增、删除或修改统计相关列）时使其所在周及之后各周的报表缓存失效
+CREATE OR REPLACE FUNCTION invalidate_weekly_stats() RETURNS trigger AS $fn$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_advisory_xact_lock_shared(
+            hashtext('report_weekly_stats:' || OLD.tenant_id)
+        );
+        DELETE FROM report_weekly_stats
+        WHERE tenant_id = OLD.tenant_id
+        AND week_start > COALESCE(OLD.due_date, OLD.created_at) - INTERVAL '1 week';
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_advisory_xact_lock_shared(
+            hashtext('report_weekly_stats:' || NEW.tenant_id)
+        );
+        DELETE FROM report_weekly_stats
+        WHERE tenant_id = NEW.tenant_id
+        AND week_start > COALESCE(NEW.due_date, NEW.created_at) - INTERVAL '1 week';
+    END IF;
+    RETURN NULL;
+END
+$fn$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS tasks_invalidate_weekly_stats ON tasks;
+CREATE TRIGGER tasks_invalidate_weekly_stats
+    AFTER INSERT OR DELETE OR UPDATE OF
+        tenant_id, priority, is_completed, due_date, created_at, completed_at
+    ON tasks
+    FOR EACH ROW EXECUTE FUNCTION invalidate_weekly_stats();
 
 -- 可选：插入一条测试数据
 INSERT INTO tasks (title, description, priority, due_date)
@@ -1,8 +1,20 @@
 import psycopg2
 from psycopg2 import OperationalError, Error
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from dotenv import load_dotenv
 import os
+import sys
+import json
+import re
+import time
+import bisect
+import hashlib
 import datetime
+import heapq
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split
@@ -12,37 +24,710 @@ from sklearn.preprocessing import StandardScaler
 # 加载环境变量
 load_dotenv()
 
+# 写操作后读请求固定走主库的时长（秒），避免从库复制延迟导致读不到刚写入的数据
+READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", 5))
+# 从库健康检查间隔、以及从库故障后重试前的等待时间（秒）
+REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", 10))
+REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", 30))
 
-def create_connection():
-    """创建PostgreSQL数据库连接"""
+# 多租户：未指定租户时使用默认租户；未配置 SHARD_DSNS 时只有一个默认分片
+DEFAULT_TENANT = "default"
+DEFAULT_SHARD = "default"
+# 一致性哈希环上每个分片的虚拟节点数，以及每个分片连接池的大小
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", 64))
+SHARD_POOL_MIN = int(os.getenv("SHARD_POOL_MIN", 1))
+SHARD_POOL_MAX = int(os.getenv("SHARD_POOL_MAX", 5))
+# 每个分片独占的任务ID区间大小（第 k 个登记的分片使用 k*区间+1 起的ID）
+SHARD_ID_RANGE = 1 << 40
+
+# 训练数据快照文件（.npy结构化数组，水位信息保存在同名.meta.json中），
+# 每个租户一份，文件名中附加租户标识
+TRAINING_SNAPSHOT_PATH = os.getenv("TRAINING_SNAPSHOT_PATH", "training_snapshot.npy")
+TRAINING_DTYPE = np.dtype([
+    ("id", "i8"),
+    ("priority", "i2"),
+    ("hours_available", "f8"),
+    ("success", "i1"),
+])
+
+# 每个任务的模型特征与标签（训练和统计报表共用）：label_time 为标签确定的时刻
+# （按时完成取完成时间，其余取截止时间）
+TASK_FEATURES_SQL = """
+        SELECT
+            tasks.*,
+            (EXTRACT(EPOCH FROM (due_date - created_at)) / 3600)::float8
+                AS hours_available,
+            CASE
+                WHEN is_completed = TRUE AND completed_at <= due_date THEN 1  -- 按时完成
+                WHEN is_completed = TRUE AND completed_at > due_date THEN 0  -- 逾期完成
+                -- 逾期未完成
+                WHEN is_completed = FALSE AND due_date < CURRENT_TIMESTAMP THEN 0
+                ELSE NULL  -- 排除未到期且未完成的任务
+            END AS success,
+            CASE
+                WHEN is_completed = TRUE AND completed_at <= due_date THEN completed_at
+                ELSE due_date
+            END AS label_time
+        FROM tasks
+        WHERE tenant_id = %(tenant)s
+"""
+
+# 训练数据：只考虑有截止日期、且已确定结果的任务
+TRAINING_FEATURES_SQL = f"""
+    SELECT id, priority, hours_available, success FROM ({TASK_FEATURES_SQL}) AS features
+    WHERE success IS NOT NULL AND hours_available > 0
+"""
+
+# 快照之后的增量：导出后有过写入（updated_at 由触发器按实际写入时刻维护）或被删除的任务，
+# 以及未被修改、但截止时间在导出之后才过去而产生标签的任务。各部分分别走
+# (tenant_id, updated_at) 和 (tenant_id, due_date) 索引。success 为 NULL 的行只用于
+# 从快照中剔除同一ID的旧数据
+TRAINING_DELTA_SQL = f"""
+    SELECT
+        id, priority, hours_available,
+        CASE WHEN success IS NOT NULL AND hours_available > 0 THEN success END
+    FROM ({TASK_FEATURES_SQL}) AS features
+    WHERE updated_at >= %(changed_since)s
+    UNION
+    SELECT id, priority, hours_available, success
+    FROM ({TASK_FEATURES_SQL}) AS features
+    WHERE due_date > %(watermark)s AND due_date <= CURRENT_TIMESTAMP
+    AND success IS NOT NULL AND hours_available > 0
+    UNION ALL
+    SELECT task_id, NULL, NULL, NULL FROM task_deletions
+    WHERE tenant_id = %(tenant)s AND deleted_at >= %(changed_since)s
+"""
+
+
+def _connection_params(dsn=None):
+    """数据库连接参数（指定dsn时按dsn连接，否则使用DB_*环境变量）"""
+    if dsn:
+        return {"dsn": dsn}
+    return {
+        "host": os.getenv("DB_HOST", "localhost"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD"),
+        "database": os.getenv("DB_NAME"),
+        "port": os.getenv("DB_PORT", 5432),
+    }
+
+
+def create_connection(dsn=None):
+    """创建PostgreSQL数据库连接（指定dsn时按dsn连接，否则使用DB_*环境变量）"""
     connection = None
     try:
-        connection = psycopg2.connect(
-            host=os.getenv("DB_HOST", "localhost"),
-            user=os.getenv("DB_USER", "postgres"),
-            password=os.getenv("DB_PASSWORD"),
-            database=os.getenv("DB_NAME"),
-            port=os.getenv("DB_PORT", 5432)
-        )
+        connection = psycopg2.connect(**_connection_params(dsn))
         print("数据库连接成功")
     except OperationalError as err:
         print(f"数据库连接错误: {err}")
     return connection
 
 
+def get_primary_dsn():
+    """读取主库DSN（未配置时返回None，沿用DB_*环境变量）"""
+    return os.getenv("DB_PRIMARY_DSN") or None
+
+
+def get_replica_dsns():
+    """读取从库DSN列表（DB_REPLICA_DSNS，逗号分隔）"""
+    raw = os.getenv("DB_REPLICA_DSNS", "")
+    return [dsn.strip() for dsn in raw.split(",") if dsn.strip()]
+
+
+class ConnectionRouter:
+    """读写分离路由：写操作和读己之写走主库，只读查询轮询分发到从库"""
+
+    def __init__(
+        self, primary, replica_dsns=(), connect=create_connection, log=print
+    ):
+        self.primary = primary
+        self.log = log
+        self._connect = connect
+        self._replicas = [
+            {"dsn": dsn, "conn": None, "checked_at": 0.0, "down_until": 0.0}
+            for dsn in replica_dsns
+        ]
+        self._next = 0
+        self._pinned_until = 0.0
+
+    def writer(self):
+        """返回主库连接（写操作提交后需调用 mark_written）"""
+        return self.primary
+
+    def mark_written(self):
+        """写操作提交后调用：在一段时间内把后续读请求固定到主库（读己之写）"""
+        self._pinned_until = time.monotonic() + READ_YOUR_WRITES_SECONDS
+
+    def reader(self):
+        """轮询返回健康的从库连接，无可用从库或处于读己之写窗口时回退到主库"""
+        if not self._replicas or time.monotonic() < self._pinned_until:
+            return self.primary
+        for _ in range(len(self._replicas)):
+            replica = self._replicas[self._next]
+            self._next = (self._next + 1) % len(self._replicas)
+            connection = self._check_replica(replica)
+            if connection is not None:
+                return connection
+        return self.primary
+
+    def read(self, query):
+        """在 reader() 选出的连接上执行只读操作 query(connection) 并返回结果
+
+        从库在查询中途失效（抛出 OperationalError 或连接已断开）时，标记该从库不可用，
+        并在主库上重试一次。
+        """
+        connection = self.reader()
+        try:
+            result = query(connection)
+        except OperationalError as err:
+            if connection is self.primary:
+                raise
+            failure = err
+        else:
+            if connection is self.primary or not connection.closed:
+                return result
+            failure = "连接已断开"
+        for replica in self._replicas:
+            if replica["conn"] is connection:
+                self._mark_down(replica, time.monotonic())
+        self.log(f"从库查询失败，已改用主库重试: {failure}")
+        return query(self.primary)
+
+    def _mark_down(self, replica, now):
+        """关闭从库连接，在 REPLICA_RETRY_SECONDS 内不再使用"""
+        replica["conn"].close()
+        replica["conn"] = None
+        replica["down_until"] = now + REPLICA_RETRY_SECONDS
+
+    def _check_replica(self, replica):
+        """检查从库是否可用，必要时重连；不可用时返回None"""
+        now = time.monotonic()
+        if now < replica["down_until"]:
+            return None
+
+        connection = replica["conn"]
+        if connection is None or connection.closed:
+            connection = self._connect(replica["dsn"])
+            if connection is None:
+                replica["down_until"] = now + REPLICA_RETRY_SECONDS
+                return None
+            # 从库只读且自动提交，避免误写和长事务
+            connection.set_session(readonly=True, autocommit=True)
+            replica["conn"] = connection
+            replica["checked_at"] = 0.0
+
+        if now - replica["checked_at"] < REPLICA_CHECK_INTERVAL:
+            return connection
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            replica["checked_at"] = now
+            return connection
+        except Error as err:
+            self.log(f"从库健康检查失败，暂时回退到主库: {err}")
+            self._mark_down(replica, now)
+            return None
+
+    def close(self):
+        """关闭所有从库连接（主库连接由调用方归还连接池）"""
+        for replica in self._replicas:
+            if replica["conn"] is not None:
+                replica["conn"].close()
+                replica["conn"] = None
+
+
+def _read(connection, query):
+    """在数据库连接或读写分离路由（ConnectionRouter）上执行只读操作"""
+    if isinstance(connection, ConnectionRouter):
+        return connection.read(query)
+    return query(connection)
+
+
+def get_shard_dsns():
+    """读取分片配置（SHARD_DSNS，JSON对象：分片名 -> DSN）；未配置时只有默认分片"""
+    raw = os.getenv("SHARD_DSNS")
+    if not raw:
+        return {DEFAULT_SHARD: get_primary_dsn()}
+    return json.loads(raw)
+
+
+def _hash_key(key):
+    """一致性哈希使用的64位哈希值"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardMap:
+    """租户分片路由：一致性哈希把租户分配到分片，每个分片一个连接池
+
+    配置了租户目录（tenant_shards 表）时，租户首次出现按哈希登记分片，
+    之后以目录为准，迁移工具修改目录即可把租户移到其他分片。
+    """
+
+    def __init__(self, shard_dsns, directory=None, vnodes=SHARD_VNODES):
+        self.shard_dsns = dict(shard_dsns)
+        self.directory = directory
+        ring = sorted(
+            (_hash_key(f"{name}#{i}"), name)
+            for name in self.shard_dsns for i in range(vnodes)
+        )
+        self._ring_keys = [key for key, _ in ring]
+        self._ring_names = [name for _, name in ring]
+        self._placements = {}
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        # 目录连接在写保护期间持有事务，其他线程需等待
+        self._directory_lock = threading.RLock()
+
+    def hashed_shard(self, tenant_id):
+        """按一致性哈希计算租户所属分片"""
+        index = bisect.bisect(self._ring_keys, _hash_key(tenant_id))
+        return self._ring_names[index % len(self._ring_names)]
+
+    def shard_for(self, tenant_id, log=print):
+        """返回租户所在分片（目录不可用时返回None）"""
+        if self.directory is None:
+            return self.hashed_shard(tenant_id)
+        if tenant_id in self._placements:
+            return self._placements[tenant_id]
+        with self._directory_lock:
+            try:
+                cursor = self.directory.cursor()
+                cursor.execute("""
+                    INSERT INTO tenant_shards (tenant_id, shard) VALUES (%s, %s)
+                    ON CONFLICT (tenant_id) DO NOTHING
+                """, (tenant_id, self.hashed_shard(tenant_id)))
+                cursor.execute(
+                    "SELECT shard FROM tenant_shards WHERE tenant_id = %s", (tenant_id,)
+                )
+                shard = cursor.fetchone()[0]
+                self.directory.commit()
+            except Error as err:
+                log(f"查询租户分片失败: {err}")
+                self.directory.rollback()
+                return None
+        self._placements[tenant_id] = shard
+        return shard
+
+    def getconn(self, shard, log=print):
+        """从分片连接池取出一个连接（失败时返回None）"""
+        try:
+            with self._pools_lock:
+                if shard not in self._pools:
+                    self._pools[shard] = ThreadedConnectionPool(
+                        SHARD_POOL_MIN, SHARD_POOL_MAX,
+                        **_connection_params(self.shard_dsns[shard])
+                    )
+            return self._pools[shard].getconn()
+        except (OperationalError, PoolError) as err:
+            log(f"连接分片 {shard} 失败: {err}")
+            return None
+
+    def putconn(self, shard, connection):
+        """把连接归还到分片连接池"""
+        self._pools[shard].putconn(connection)
+
+    def begin_write(self, tenant_id, shard):
+        """写操作前对租户目录记录加共享锁：迁移中或已迁走的租户拒绝写入
+
+        返回True时必须在写操作结束后调用 end_write；迁移工具修改目录时会等待
+        这些写操作完成，从而保证迁移期间不会有写入落到旧分片。
+        """
+        if self.directory is None:
+            return True
+        self._directory_lock.acquire()
+        try:
+            cursor = self.directory.cursor()
+            cursor.execute(
+                "SELECT shard, moving FROM tenant_shards "
+                "WHERE tenant_id = %s FOR SHARE",
+                (tenant_id,),
+            )
+            row = cursor.fetchone()
+        except Error as err:
+            print(f"检查租户分片失败: {err}")
+            row = None
+        if row and not row[1] and row[0] == shard:
+            return True
+        if row is None:
+            print("未找到租户分片信息，暂时无法写入!")
+        elif row[1]:
+            print("租户正在迁移，暂时无法写入，请稍后再试!")
+        else:
+            print("租户已迁移到其他分片，请重新操作!")
+        self.directory.rollback()
+        self._directory_lock.release()
+        return False
+
+    def end_write(self):
+        """写操作结束，释放租户目录记录上的锁"""
+        if self.directory is None:
+            return
+        try:
+            self.directory.commit()
+        finally:
+            self._directory_lock.release()
+
+    @contextlib.contextmanager
+    def write_guard(self, tenant_id, shard):
+        """写保护上下文（begin_write/end_write），产出是否允许写入
+
+        只应包住SQL执行：持有期间迁移工具无法修改目录，不能在其中等待用户输入。
+        """
+        allowed = self.begin_write(tenant_id, shard)
+        try:
+            yield allowed
+        finally:
+            if allowed:
+                self.end_write()
+
+    def current_shard(self, tenant_id):
+        """不加锁地重新读取租户目录，返回租户当前所在分片（查询失败时返回None）
+
+        读操作前调用，以发现会话开始后租户被迁移到其他分片的情况。
+        """
+        if self.directory is None:
+            return self.hashed_shard(tenant_id)
+        with self._directory_lock:
+            try:
+                cursor = self.directory.cursor()
+                cursor.execute(
+                    "SELECT shard FROM tenant_shards WHERE tenant_id = %s", (tenant_id,)
+                )
+                row = cursor.fetchone()
+                self.directory.commit()
+            except Error as err:
+                print(f"查询租户分片失败: {err}")
+                self.directory.rollback()
+                return None
+        if row is None:
+            return None
+        self._placements[tenant_id] = row[0]
+        return row[0]
+
+    def move_state(self, tenant_id):
+        """读取租户目录中的迁移进度：(分片, 是否迁移中, 待清理的源分片, 目标分片)"""
+        with self._directory_lock:
+            try:
+                cursor = self.directory.cursor()
+                cursor.execute("""
+                    SELECT shard, moving, move_source, move_target
+                    FROM tenant_shards WHERE tenant_id = %s
+                """, (tenant_id,))
+                row = cursor.fetchone()
+                self.directory.commit()
+            except Error as err:
+                print(f"查询租户分片失败: {err}")
+                self.directory.rollback()
+                return None
+        if row is None:
+            print("未找到租户分片信息!")
+        return row
+
+    def update_placement(self, tenant_id, shard=None, moving=False,
+                         move_source=None, move_target=None):
+        """修改租户目录：标记/取消迁移状态，记录迁移进度，或指向新分片"""
+        with self._directory_lock:
+            try:
+                cursor = self.directory.cursor()
+                cursor.execute("""
+                    UPDATE tenant_shards
+                    SET shard = COALESCE(%s, shard), moving = %s,
+                        move_source = %s, move_target = %s
+                    WHERE tenant_id = %s
+                """, (shard, moving, move_source, move_target, tenant_id))
+                self.directory.commit()
+            except Error as err:
+                print(f"更新租户目录失败: {err}")
+                self.directory.rollback()
+                return False
+        if shard is not None:
+            self._placements[tenant_id] = shard
+        return True
+
+    def reserve_id_range(self, shard, connection):
+        """让分片的任务ID序列从该分片独占的区间分配（失败时返回False）
+
+        区间在目录中按分片登记顺序分配，迁移租户时可以原样保留任务ID。
+        """
+        if self.directory is None:
+            return True
+        with self._directory_lock:
+            try:
+                cursor = self.directory.cursor()
+                cursor.execute("LOCK TABLE shard_id_ranges IN SHARE ROW EXCLUSIVE MODE")
+                cursor.execute("""
+                    INSERT INTO shard_id_ranges (shard, range_index)
+                    SELECT %s, COALESCE(MAX(range_index) + 1, 0) FROM shard_id_ranges
+                    ON CONFLICT (shard) DO NOTHING
+                """, (shard,))
+                cursor.execute(
+                    "SELECT range_index FROM shard_id_ranges WHERE shard = %s", (shard,)
+                )
+                range_index = cursor.fetchone()[0]
+                self.directory.commit()
+            except Error as err:
+                print(f"分配分片任务ID区间失败: {err}")
+                self.directory.rollback()
+                return False
+        low = range_index * SHARD_ID_RANGE + 1
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_get_serial_sequence('tasks', 'id')")
+            sequence = cursor.fetchone()[0]
+            cursor.execute(
+                f"ALTER SEQUENCE {sequence} MAXVALUE %s", (low + SHARD_ID_RANGE - 1,)
+            )
+            # 序列尚未进入区间时跳到区间起点（已有的任务ID不变）
+            cursor.execute(
+                f"SELECT setval(%s, %s, false) FROM {sequence} WHERE last_value < %s",
+                (sequence, low, low),
+            )
+            connection.commit()
+        except Error as err:
+            print(f"设置分片 {shard} 的任务ID区间失败: {err}")
+            connection.rollback()
+            return False
+        return True
+
+    def close(self):
+        """关闭所有分片连接池和目录连接"""
+        for shard_pool in self._pools.values():
+            shard_pool.closeall()
+        self._pools.clear()
+        if self.directory is not None:
+            self.directory.close()
+
+
+def initialize_directory(connection):
+    """初始化租户目录表（记录租户所在分片及迁移状态）"""
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tenant_shards (
+                tenant_id TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                moving BOOLEAN NOT NULL DEFAULT FALSE
+            );
+            -- 迁移进度：move_target 为迁移中的目标分片，move_source 为待清理的源分片
+            ALTER TABLE tenant_shards ADD COLUMN IF NOT EXISTS move_source TEXT;
+            ALTER TABLE tenant_shards ADD COLUMN IF NOT EXISTS move_target TEXT;
+            -- 每个分片按登记顺序占用一段任务ID区间，各分片的任务ID互不重叠
+            CREATE TABLE IF NOT EXISTS shard_id_ranges (
+                shard TEXT PRIMARY KEY,
+                range_index INTEGER NOT NULL UNIQUE
+            );
+        """)
+        connection.commit()
+    except Error as err:
+        print(f"初始化租户目录失败: {err}")
+        connection.rollback()
+
+
+_shard_map = None
+
+
+def get_shard_map():
+    """按环境变量创建（并缓存）分片路由；配置了多分片但目录库不可用时返回None"""
+    global _shard_map
+    if _shard_map is None:
+        directory = None
+        if os.getenv("SHARD_DSNS"):
+            directory = create_connection(
+                os.getenv("SHARD_DIRECTORY_DSN") or get_primary_dsn()
+            )
+            if not directory:
+                return None
+            initialize_directory(directory)
+        _shard_map = ShardMap(get_shard_dsns(), directory)
+    return _shard_map
+
+
+def _unguarded():
+    """默认的写保护：不做检查，直接允许写入"""
+    return contextlib.nullcontext(True)
+
+
 def initialize_table(connection):
     """初始化任务表（如果不存在）"""
     create_table_query = """
     CREATE TABLE IF NOT EXISTS tasks (
-        id SERIAL PRIMARY KEY,
+        id BIGSERIAL PRIMARY KEY,
         title VARCHAR(255) NOT NULL,
         description TEXT,
         priority INTEGER NOT NULL DEFAULT 3 CHECK (priority BETWEEN 1 AND 5),
         is_completed BOOLEAN NOT NULL DEFAULT FALSE,
         due_date TIMESTAMPTZ,
         created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
-        completed_at TIMESTAMPTZ
+        completed_at TIMESTAMPTZ,
+        estimated_hours REAL CHECK (estimated_hours >= 0),
+        tenant_id TEXT NOT NULL DEFAULT 'default'
+    );
+    -- 兼容已存在的旧表结构
+    ALTER TABLE tasks ADD COLUMN IF NOT EXISTS estimated_hours REAL
+        CHECK (estimated_hours >= 0);
+    ALTER TABLE tasks ADD COLUMN IF NOT EXISTS tenant_id TEXT NOT NULL
+        DEFAULT 'default';
+    CREATE INDEX IF NOT EXISTS idx_tasks_tenant_due ON tasks (tenant_id, due_date);
+    -- 统计报表按 COALESCE(due_date, created_at) 所在周聚合，只扫描未缓存的周
+    CREATE INDEX IF NOT EXISTS idx_tasks_tenant_week
+        ON tasks (tenant_id, COALESCE(due_date, created_at));
+
+    -- 变更跟踪（训练快照补充增量用）：updated_at 取实际写入时刻（clock_timestamp），
+    -- 而不是事务开始时间；删除的任务记录到 task_deletions
+    ALTER TABLE tasks ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL
+        DEFAULT clock_timestamp();
+    CREATE INDEX IF NOT EXISTS idx_tasks_tenant_updated
+        ON tasks (tenant_id, updated_at);
+    CREATE TABLE IF NOT EXISTS task_deletions (
+        task_id BIGINT NOT NULL,
+        tenant_id TEXT NOT NULL,
+        deleted_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
     );
+    CREATE INDEX IF NOT EXISTS idx_task_deletions_tenant
+        ON task_deletions (tenant_id, deleted_at);
+    CREATE OR REPLACE FUNCTION track_task_changes() RETURNS trigger AS $fn$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO task_deletions (task_id, tenant_id)
+                VALUES (OLD.id, OLD.tenant_id);
+            RETURN OLD;
+        END IF;
+        NEW.updated_at := clock_timestamp();
+        RETURN NEW;
+    END
+    $fn$ LANGUAGE plpgsql;
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = 'tasks_track_changes') THEN
+            CREATE TRIGGER tasks_track_changes
+                BEFORE INSERT OR UPDATE OR DELETE ON tasks
+                FOR EACH ROW EXECUTE FUNCTION track_task_changes();
+        END IF;
+    END $$;
+
+    -- 任务依赖：task_id 依赖 depends_on_id（后者完成后前者才能开始）
+    CREATE TABLE IF NOT EXISTS task_dependencies (
+        task_id BIGINT NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+        depends_on_id BIGINT NOT NULL REFERENCES tasks(id) ON DELETE CASCADE,
+        PRIMARY KEY (task_id, depends_on_id),
+        CHECK (task_id <> depends_on_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_task_dependencies_depends_on
+        ON task_dependencies (depends_on_id);
+    -- 任务ID改为BIGINT：各分片从不重叠的ID区间分配，迁移租户时保留原任务ID
+    DO $$
+    BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_name = 'tasks' AND column_name = 'id') = 'integer' THEN
+            ALTER TABLE tasks ALTER COLUMN id TYPE BIGINT;
+            EXECUTE format('ALTER SEQUENCE %s AS BIGINT',
+                           pg_get_serial_sequence('tasks', 'id'));
+            ALTER TABLE task_dependencies
+                ALTER COLUMN task_id TYPE BIGINT,
+                ALTER COLUMN depends_on_id TYPE BIGINT;
+            ALTER TABLE task_deletions ALTER COLUMN task_id TYPE BIGINT;
+        END IF;
+    END $$;
+    -- 依赖版本号：依赖增删时按租户递增，与 MAX(updated_at) 一起判断缓存的依赖图是否过期
+    CREATE TABLE IF NOT EXISTS task_dependency_versions (
+        tenant_id TEXT PRIMARY KEY,
+        version BIGINT NOT NULL
+    );
+    CREATE OR REPLACE FUNCTION bump_dependency_version() RETURNS trigger AS $fn$
+    DECLARE
+        changed BIGINT :=
+            CASE WHEN TG_OP = 'DELETE' THEN OLD.task_id ELSE NEW.task_id END;
+    BEGIN
+        INSERT INTO task_dependency_versions (tenant_id, version)
+        SELECT tenant_id, 1 FROM tasks WHERE id = changed
+        ON CONFLICT (tenant_id)
+            DO UPDATE SET version = task_dependency_versions.version + 1;
+        RETURN NULL;
+    END
+    $fn$ LANGUAGE plpgsql;
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = 'task_dependencies_bump_version') THEN
+            CREATE TRIGGER task_dependencies_bump_version
+                AFTER INSERT OR DELETE ON task_dependencies
+                FOR EACH ROW EXECUTE FUNCTION bump_dependency_version();
+        END IF;
+    END $$;
+
+    -- 统计报表缓存：已结束的周按租户、优先级聚合后的结果
+    -- （旧版缓存表没有租户维度；缓存可随时重建，直接删除）
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.tables
+                   WHERE table_name = 'report_weekly_stats')
+           AND NOT EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_name = 'report_weekly_stats'
+                           AND column_name = 'tenant_id') THEN
+            DROP TABLE report_weekly_stats;
+        END IF;
+    END $$;
+    CREATE TABLE IF NOT EXISTS report_weekly_stats (
+        tenant_id TEXT NOT NULL,
+        week_start TIMESTAMPTZ NOT NULL,
+        priority INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        completed INTEGER NOT NULL,
+        labeled INTEGER NOT NULL,
+        on_time INTEGER NOT NULL,
+        late INTEGER NOT NULL,
+        lateness_hours DOUBLE PRECISION NOT NULL,
+        feature_rows INTEGER NOT NULL,
+        feature_success INTEGER NOT NULL,
+        hours_available_sum DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (tenant_id, week_start, priority)
+    );
+    -- 任务变化时删除其所在周及之后各周的缓存，使缓存始终是连续的前缀，
+    -- 报表从最后一个缓存周之后重新聚合即可覆盖变化的任务。按时间范围删除，
+    -- 与会话时区下的周边界无关。共享咨询锁与 run_report 的排他锁配合，
+    -- 避免报表把并发写入之前的旧聚合结果写回缓存。只有影响统计的列被修改时才触发
+    CREATE OR REPLACE FUNCTION invalidate_weekly_stats() RETURNS trigger AS $fn$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_advisory_xact_lock_shared(
+                hashtext('report_weekly_stats:' || OLD.tenant_id)
+            );
+            DELETE FROM report_weekly_stats
+            WHERE tenant_id = OLD.tenant_id
+            AND week_start > COALESCE(OLD.due_date, OLD.created_at) - INTERVAL '1 week';
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_advisory_xact_lock_shared(
+                hashtext('report_weekly_stats:' || NEW.tenant_id)
+            );
+            DELETE FROM report_weekly_stats
+            WHERE tenant_id = NEW.tenant_id
+            AND week_start > COALESCE(NEW.due_date, NEW.created_at) - INTERVAL '1 week';
+        END IF;
+        RETURN NULL;
+    END
+    $fn$ LANGUAGE plpgsql;
+    DO $$
+    BEGIN
+        -- 旧版触发器对任何 UPDATE 都会触发，替换为只监听统计相关列
+        IF EXISTS (SELECT 1 FROM pg_trigger
+                   WHERE tgname = 'tasks_invalidate_weekly_stats'
+                   AND cardinality(tgattr::int2[]) = 0) THEN
+            DROP TRIGGER tasks_invalidate_weekly_stats ON tasks;
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = 'tasks_invalidate_weekly_stats') THEN
+            CREATE TRIGGER tasks_invalidate_weekly_stats
+                AFTER INSERT OR DELETE OR UPDATE OF
+                    tenant_id, priority, is_completed,
+                    due_date, created_at, completed_at
+                ON tasks
+                FOR EACH ROW EXECUTE FUNCTION invalidate_weekly_stats();
+        END IF;
+    END $$;
     """
     try:
         cursor = connection.cursor()
@@ -54,7 +739,7 @@ def initialize_table(connection):
         connection.rollback()
 
 
-def add_task(conn):
+def add_task(conn, tenant_id=DEFAULT_TENANT, guard=_unguarded):
     # 1. 获取用户输入（补充优先级的获取逻辑）
     title = input("请输入任务标题: ")
     description = input("请输入任务描述 (可选): ")
@@ -67,38 +752,56 @@ def add_task(conn):
     # 新增：获取截止日期输入（可选，留空则为None）
     due_date_str = input("请输入截止日期 (格式: YYYY-MM-DD HH:MM, 可选): ")
     due_date = due_date_str if due_date_str.strip() else None  # 或转换为datetime对象
+
+    # 新增：获取预估工时（小时，可选），用于依赖排期
+    hours_str = input("请输入预估工时 (小时, 可选): ").strip()
+    estimated_hours = None
+    if hours_str:
+        try:
+            estimated_hours = float(hours_str)
+        except ValueError:
+            print("无效的工时!")
+            return
+        if not 0 <= estimated_hours < float("inf"):
+            print("无效的工时!")
+            return
     
-    # 2. 执行INSERT语句（保留原逻辑，补充概率预测）
-    try:
-        cursor = conn.cursor()
-        insert_sql = """
-            INSERT INTO tasks (title, description, priority, due_date, created_at, is_completed)
-            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP, FALSE)
-            RETURNING id;
-        """
-        cursor.execute(insert_sql, (title, description, priority, due_date))
+    # 2. 执行INSERT语句（保留原逻辑，补充概率预测），只在写保护内执行SQL
+    with guard() as allowed:
+        if not allowed:
+            return
+        try:
+            cursor = conn.cursor()
+            insert_sql = """
+                INSERT INTO tasks (tenant_id, title, description, priority, due_date,
+                                   estimated_hours, created_at, is_completed)
+                VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP, FALSE)
+                RETURNING id;
+            """
+            cursor.execute(
+                insert_sql,
+                (tenant_id, title, description, priority, due_date, estimated_hours),
+            )
         
-        # 3. 获取返回的任务ID并提交
-        task_id = cursor.fetchone()[0]
-        conn.commit()
-        print(f"任务添加成功! 任务ID: {task_id}")
+            # 3. 获取返回的任务ID并提交
+            task_id = cursor.fetchone()[0]
+            conn.commit()
+            print(f"任务添加成功! 任务ID: {task_id}")
         
-        # 新增：任务添加成功后，预测完成概率（复用原有预测逻辑）
-        if has_enough_data(conn):
-            probability = predict_completion_probability(conn, task_id)
-            print(f"预测该任务按时完成的概率: {probability:.1%}")
-            
-    except Error as err:
-        print(f"添加任务失败: {err}")
-        conn.rollback()  # 出错时回滚事务
-    finally:
-        if 'cursor' in locals():  # 确保游标关闭
-            cursor.close()
+            # 新增：任务添加成功后，在后台预测完成概率，结果在返回菜单时输出
+            submit_prediction(task_id, tenant_id)
+
+        except Error as err:
+            print(f"添加任务失败: {err}")
+            conn.rollback()  # 出错时回滚事务
+        finally:
+            if 'cursor' in locals():  # 确保游标关闭
+                cursor.close()
 
 
 
-def view_tasks(connection):
-    """查询任务"""
+def view_tasks(connection, tenant_id=DEFAULT_TENANT):
+    """查询任务（connection 也可以是 ConnectionRouter，查询分发到从库）"""
     print("\n查询选项:")
     print("1. 查看所有任务")
     print("2. 查看未完成任务")
@@ -108,41 +811,47 @@ def view_tasks(connection):
     print("6. 查看任务完成概率预测")
 
     choice = input("请选择查询方式 (1-6): ").strip()
-    query = "SELECT * FROM tasks"
-    params = []
+    query = "SELECT * FROM tasks WHERE tenant_id = %s"
+    params = [tenant_id]
 
     if choice == '1':
         query += " ORDER BY created_at DESC"
     elif choice == '2':
-        query += " WHERE is_completed = FALSE ORDER BY due_date ASC NULLS LAST"
+        query += " AND is_completed = FALSE ORDER BY due_date ASC NULLS LAST"
     elif choice == '3':
-        query += " WHERE is_completed = TRUE ORDER BY completed_at DESC NULLS LAST"
+        query += " AND is_completed = TRUE ORDER BY completed_at DESC NULLS LAST"
     elif choice == '4':
         priority = input("请输入要查询的优先级 (1-5): ").strip()
         if priority in ['1', '2', '3', '4', '5']:
-            query += " WHERE priority = %s ORDER BY due_date ASC NULLS LAST"
+            query += " AND priority = %s ORDER BY due_date ASC NULLS LAST"
             params.append(priority)
         else:
             print("无效的优先级!")
             return
     elif choice == '5':
         date_str = input("请输入要查询的截止日期 (格式: YYYY-MM-DD): ").strip()
-        query += " WHERE DATE(due_date) = %s ORDER BY due_date ASC"
+        query += " AND DATE(due_date) = %s ORDER BY due_date ASC"
         params.append(date_str)
     elif choice == '6':
-        if has_enough_data(connection):
-            view_predicted_probabilities(connection)
-        else:
-            print("数据不足，无法进行预测。至少需要10个已完成或逾期的任务。")
+        def predict(conn):
+            if has_enough_data(conn, tenant_id):
+                view_predicted_probabilities(conn, tenant_id)
+            else:
+                print("数据不足，无法进行预测。至少需要10个已完成或逾期的任务。")
+
+        _read(connection, predict)
         return
     else:
         print("无效的选择!")
         return
 
-    try:
-        cursor = connection.cursor()
+    def fetch(conn):
+        cursor = conn.cursor()
         cursor.execute(query, params)
-        tasks = cursor.fetchall()
+        return cursor.fetchall()
+
+    try:
+        tasks = _read(connection, fetch)
 
         if not tasks:
             print("没有找到符合条件的任务!")
@@ -168,8 +877,8 @@ def view_tasks(connection):
         print(f"查询任务失败: {err}")
 
 
-def update_task(connection):
-    """更新任务状态"""
+def update_task(connection, tenant_id=DEFAULT_TENANT, guard=_unguarded):
+    """更新任务状态（成功时返回任务ID）"""
     task_id = input("请输入要更新的任务ID: ").strip()
     if not task_id.isdigit():
         print("无效的任务ID!")
@@ -180,8 +889,9 @@ def update_task(connection):
     print("2. 标记任务为未完成")
     print("3. 修改任务标题")
     print("4. 修改任务截止日期")
+    print("5. 修改任务预估工时")
 
-    choice = input("请选择更新方式 (1-4): ").strip()
+    choice = input("请选择更新方式 (1-5): ").strip()
     query = ""
     params = []
 
@@ -189,45 +899,61 @@ def update_task(connection):
         query = """
         UPDATE tasks 
         SET is_completed = TRUE, completed_at = CURRENT_TIMESTAMP 
-        WHERE id = %s
+        WHERE id = %s AND tenant_id = %s
         """
-        params = [task_id]
+        params = [task_id, tenant_id]
     elif choice == '2':
         query = """
         UPDATE tasks 
         SET is_completed = FALSE, completed_at = NULL 
-        WHERE id = %s
+        WHERE id = %s AND tenant_id = %s
         """
-        params = [task_id]
+        params = [task_id, tenant_id]
     elif choice == '3':
         new_title = input("请输入新的任务标题: ").strip()
         if not new_title:
             print("任务标题不能为空!")
             return
-        query = "UPDATE tasks SET title = %s WHERE id = %s"
-        params = [new_title, task_id]
+        query = "UPDATE tasks SET title = %s WHERE id = %s AND tenant_id = %s"
+        params = [new_title, task_id, tenant_id]
     elif choice == '4':
         new_date = input("请输入新的截止日期 (格式: YYYY-MM-DD HH:MM): ").strip()
-        query = "UPDATE tasks SET due_date = %s WHERE id = %s"
-        params = [new_date, task_id]
+        query = "UPDATE tasks SET due_date = %s WHERE id = %s AND tenant_id = %s"
+        params = [new_date, task_id, tenant_id]
+    elif choice == '5':
+        new_hours = input("请输入新的预估工时 (小时): ").strip()
+        try:
+            hours = float(new_hours)
+        except ValueError:
+            print("无效的工时!")
+            return
+        if not 0 <= hours < float("inf"):
+            print("无效的工时!")
+            return
+        query = "UPDATE tasks SET estimated_hours = %s WHERE id = %s AND tenant_id = %s"
+        params = [hours, task_id, tenant_id]
     else:
         print("无效的选择!")
         return
 
-    try:
-        cursor = connection.cursor()
-        cursor.execute(query, params)
-        connection.commit()
-        if cursor.rowcount > 0:
-            print("任务更新成功!")
-        else:
+    with guard() as allowed:
+        if not allowed:
+            return None
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, params)
+            connection.commit()
+            if cursor.rowcount > 0:
+                print("任务更新成功!")
+                return int(task_id)
             print("未找到该任务ID或未发生变更!")
-    except Error as err:
-        print(f"更新任务失败: {err}")
-        connection.rollback()
+        except Error as err:
+            print(f"更新任务失败: {err}")
+            connection.rollback()
+    return None
 
 
-def delete_task(connection):
+def delete_task(connection, tenant_id=DEFAULT_TENANT, guard=_unguarded):
     """删除任务"""
     task_id = input("请输入要删除的任务ID: ").strip()
     if not task_id.isdigit():
@@ -239,64 +965,182 @@ def delete_task(connection):
         print("已取消删除!")
         return
 
-    query = "DELETE FROM tasks WHERE id = %s"
-    try:
-        cursor = connection.cursor()
-        cursor.execute(query, (task_id,))
-        connection.commit()
-        if cursor.rowcount > 0:
-            print("任务删除成功!")
-        else:
-            print("未找到该任务ID!")
-    except Error as err:
-        print(f"删除任务失败: {err}")
-        connection.rollback()
+    query = "DELETE FROM tasks WHERE id = %s AND tenant_id = %s"
+    with guard() as allowed:
+        if not allowed:
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query, (task_id, tenant_id))
+            connection.commit()
+            if cursor.rowcount > 0:
+                print("任务删除成功!")
+            else:
+                print("未找到该任务ID!")
+        except Error as err:
+            print(f"删除任务失败: {err}")
+            connection.rollback()
 
 
-def has_enough_data(connection):
+def has_enough_data(connection, tenant_id=DEFAULT_TENANT, log=print):
     """检查是否有足够的数据进行模型训练"""
     try:
         cursor = connection.cursor()
         cursor.execute("""
             SELECT COUNT(*) FROM tasks 
-            WHERE (is_completed = TRUE AND completed_at IS NOT NULL) 
-            OR (is_completed = FALSE AND due_date < CURRENT_TIMESTAMP)
-        """)
+            WHERE tenant_id = %s
+            AND ((is_completed = TRUE AND completed_at IS NOT NULL) 
+                 OR (is_completed = FALSE AND due_date < CURRENT_TIMESTAMP))
+        """, (tenant_id,))
         count = cursor.fetchone()[0]
         return count >= 10  # 至少需要10个已完成或逾期未完成的任务
     except Error as err:
-        print(f"检查数据时出错: {err}")
+        log(f"检查数据时出错: {err}")
         return False
 
 
-def train_model(connection):
-    """训练任务完成预测模型"""
+def _snapshot_path(tenant_id):
+    """租户的默认快照路径（租户标识含路径分隔符等其他字符时改用其哈希值）"""
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", tenant_id):
+        tenant_id = hashlib.md5(tenant_id.encode("utf-8")).hexdigest()
+    base, ext = os.path.splitext(TRAINING_SNAPSHOT_PATH)
+    return f"{base}.{tenant_id}{ext}"
+
+
+def _snapshot_meta_path(path):
+    """快照水位信息文件路径"""
+    return os.path.splitext(path)[0] + ".meta.json"
+
+
+def export_training_snapshot(connection, path=None, tenant_id=DEFAULT_TENANT):
+    """导出租户的训练特征快照到磁盘，并记录数据水位"""
+    path = path or _snapshot_path(tenant_id)
     try:
+        # 在新的可重复读事务中导出，快照数据与水位对应同一数据库快照
+        connection.rollback()
         cursor = connection.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        # watermark：标签时间水位；changed_since：快照中可能看不到的写入的最早时刻，
+        # 即当前时间与仍在进行中的写事务开始时间中较早者
+        # （需要能看到其他会话的 pg_stat_activity，例如同一数据库用户）
         cursor.execute("""
-            SELECT 
-                priority,
-                EXTRACT(EPOCH FROM (due_date - created_at)) / 3600 AS hours_available,
-                CASE 
-                    WHEN is_completed = TRUE AND completed_at <= due_date THEN 1  -- 按时完成
-                    WHEN is_completed = TRUE AND completed_at > due_date THEN 0  -- 逾期完成
-                    WHEN is_completed = FALSE AND due_date < CURRENT_TIMESTAMP THEN 0  -- 逾期未完成
-                    ELSE NULL  -- 排除未到期且未完成的任务
-                END AS success
-            FROM tasks
-            WHERE due_date IS NOT NULL  -- 只考虑有截止日期的任务
+            SELECT
+                CURRENT_TIMESTAMP,
+                LEAST(CURRENT_TIMESTAMP, (
+                    SELECT MIN(xact_start) FROM pg_stat_activity
+                    WHERE backend_xid IS NOT NULL AND pid <> pg_backend_pid()
+                ))
         """)
-        
-        data = cursor.fetchall()
-        # 过滤掉无效数据
-        valid_data = [row for row in data if row[2] is not None and row[1] is not None and row[1] > 0]
-        
-        if len(valid_data) < 10:
+        watermark, changed_since = cursor.fetchone()
+        cursor.execute(
+            TRAINING_FEATURES_SQL + " AND label_time <= %(watermark)s",
+            {"tenant": tenant_id, "watermark": watermark},
+        )
+        # 直接从游标构造结构化数组，不经过中间的元组列表
+        data = np.fromiter(cursor, dtype=TRAINING_DTYPE)
+        connection.rollback()
+    except Error as err:
+        print(f"导出训练数据快照失败: {err}")
+        connection.rollback()
+        return None
+
+    # 先写临时文件再替换，避免训练进程读到写了一半的快照
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, path)
+    meta_path = _snapshot_meta_path(path)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "watermark": watermark.isoformat(),
+            "changed_since": changed_since.isoformat(),
+            "rows": len(data),
+        }, f)
+    os.replace(meta_path + ".tmp", meta_path)
+    print(f"训练数据快照已导出: {path} (共 {len(data)} 条, 水位 {watermark})")
+
+    # 新快照只需要 changed_since 之后的删除记录，更早的可以清理
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            "DELETE FROM task_deletions WHERE tenant_id = %s AND deleted_at < %s",
+            (tenant_id, changed_since),
+        )
+        connection.commit()
+    except Error as err:
+        print(f"清理任务删除记录失败: {err}")
+        connection.rollback()
+    return watermark
+
+
+def load_training_snapshot(path=None, tenant_id=DEFAULT_TENANT, log=print):
+    """以内存映射方式读取训练数据快照，返回 (数据, 标签水位, 变更水位)
+
+    快照不存在或格式过旧时返回None；文件损坏时抛出 OSError/ValueError。
+    """
+    path = path or _snapshot_path(tenant_id)
+    meta_path = _snapshot_meta_path(path)
+    if not os.path.exists(path) or not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    data = np.load(path, mmap_mode='r')
+    if "changed_since" not in meta or data.dtype != TRAINING_DTYPE:
+        log(f"训练数据快照 {path} 格式过旧，已忽略，请重新导出")
+        return None
+    return (
+        data,
+        datetime.datetime.fromisoformat(meta["watermark"]),
+        datetime.datetime.fromisoformat(meta["changed_since"]),
+    )
+
+
+def load_training_data(
+    connection, snapshot_path=None, tenant_id=DEFAULT_TENANT, log=print
+):
+    """加载租户的训练数据：有快照时只从数据库补充快照之后的增量"""
+    cursor = connection.cursor()
+    try:
+        snapshot = load_training_snapshot(snapshot_path, tenant_id, log)
+    except (OSError, ValueError, KeyError) as err:
+        # 快照文件损坏（如写入中断）时与没有快照一样处理
+        log(f"训练数据快照无法读取，改为从数据库全量加载: {err}")
+        snapshot = None
+    if snapshot is None:
+        cursor.execute(TRAINING_FEATURES_SQL, {"tenant": tenant_id})
+        return np.fromiter(cursor, dtype=TRAINING_DTYPE)
+
+    data, watermark, changed_since = snapshot
+    cursor.execute(TRAINING_DELTA_SQL, {
+        "tenant": tenant_id, "watermark": watermark, "changed_since": changed_since,
+    })
+    rows = cursor.fetchall()
+    if not rows:
+        return data
+
+    # 快照导出后被修改或删除的任务，以增量中的最新数据为准
+    changed_ids = np.fromiter(
+        (row[0] for row in rows), dtype=np.int64, count=len(rows)
+    )
+    data = data[~np.isin(data["id"], changed_ids)]
+    delta = np.array([row for row in rows if row[3] is not None], dtype=TRAINING_DTYPE)
+    return np.concatenate((data, delta))
+
+
+def train_model(connection, tenant_id=DEFAULT_TENANT, log=print):
+    """训练任务完成预测模型（只使用该租户的数据，connection 应为租户所在分片）
+
+    log 用于输出提示信息，后台线程中调用时传入收集函数，避免打断前台输入。
+    """
+    try:
+        data = load_training_data(connection, tenant_id=tenant_id, log=log)
+
+        if len(data) < 10:
             return None, None
-        
+
         # 准备特征和目标变量
-        X = np.array([[row[0], row[1]] for row in valid_data])  # 优先级和可用小时数
-        y = np.array([row[2] for row in valid_data])  # 是否成功完成
+        X = np.column_stack((data["priority"], data["hours_available"]))  # 优先级和可用小时数
+        y = data["success"]  # 是否成功完成
         
         # 数据标准化
         scaler = StandardScaler()
@@ -313,28 +1157,34 @@ def train_model(connection):
         y_pred = model.predict(X_test)
         y_pred_binary = [1 if p >= 0.5 else 0 for p in y_pred]
         accuracy = accuracy_score(y_test, y_pred_binary)
-        print(f"模型训练完成，准确率: {accuracy:.1%}")
+        log(f"模型训练完成，准确率: {accuracy:.1%}")
         
         return model, scaler
         
     except Error as err:
-        print(f"训练模型时出错: {err}")
+        log(f"训练模型时出错: {err}")
         return None, None
 
 
-def predict_completion_probability(connection, task_id):
+def predict_completion_probability(
+    connection, task_id, tenant_id=DEFAULT_TENANT, log=print
+):
     """预测指定任务的完成概率"""
-    model, scaler = train_model(connection)
+    model, scaler = train_model(connection, tenant_id, log)
     if not model or not scaler:
         return 0.0
-        
+    return _score_task(connection, model, scaler, task_id, tenant_id, log)
+
+
+def _score_task(connection, model, scaler, task_id, tenant_id, log=print):
+    """用已训练的模型预测单个任务的完成概率"""
     try:
         cursor = connection.cursor()
         cursor.execute("""
             SELECT priority, due_date, created_at 
             FROM tasks 
-            WHERE id = %s
-        """, (task_id,))
+            WHERE id = %s AND tenant_id = %s
+        """, (task_id, tenant_id))
         
         task = cursor.fetchone()
         if not task or not task[1]:  # 没有截止日期的任务无法预测
@@ -359,27 +1209,147 @@ def predict_completion_probability(connection, task_id):
         return max(0.0, min(1.0, probability))
         
     except Error as err:
-        print(f"预测任务完成概率时出错: {err}")
+        log(f"预测任务完成概率时出错: {err}")
         return 0.0
 
 
-def view_predicted_probabilities(connection):
+# 后台预测：单线程池按提交顺序训练并预测，从租户所在分片的连接池借用连接，不占用交互连接。
+# 同一租户排队中的预测请求合并为一次训练，_pending_predictions 记录
+# 租户 -> (待预测任务ID列表, Future)
+_prediction_executor = None
+# 后台线程专用的读写分离路由（ConnectionRouter 不是线程安全的，不与前台共用）
+_prediction_router = None
+_pending_predictions = {}
+_finished_predictions = []
+_predictions_lock = threading.Lock()
+
+
+def _predict_in_background(tenant_id):
+    """后台线程：训练一次模型，预测该租户所有排队中的新任务的完成概率
+
+    线程内不直接输出，提示信息随结果一起交给 report_finished_predictions 在前台输出。
+    """
+    with _predictions_lock:
+        task_ids, _ = _pending_predictions.pop(tenant_id)
+    messages = []
+    probabilities = {}
+    try:
+        probabilities = _predict_on_shard(task_ids, tenant_id, messages.append)
+    except Exception as err:  # 后台线程的异常不会自动显示，记录下来交给前台输出
+        ids = ", ".join(str(task_id) for task_id in task_ids)
+        messages.append(f"后台预测任务 {ids} 失败: {err}")
+    with _predictions_lock:
+        _finished_predictions.append((probabilities, messages))
+
+
+def _predict_on_shard(task_ids, tenant_id, log):
+    """从租户所在分片取连接训练模型并逐个预测；数据不足或无法连接时返回空字典"""
+    shard_map = get_shard_map()
+    shard = shard_map.shard_for(tenant_id, log) if shard_map else None
+    connection = shard_map.getconn(shard, log) if shard else None
+    if not connection:
+        return {}
+    autocommit = connection.autocommit
+    try:
+        # 只执行查询，自动提交避免长时间挂起事务；归还连接池前恢复原设置
+        connection.autocommit = True
+        # 训练是只读的重负载，分发到从库；新任务刚写入主库，从库可能尚未同步，
+        # 因此按ID读取新任务仍在主库上进行
+        router = _background_router(shard_map, connection, log)
+        if not router.read(lambda conn: has_enough_data(conn, tenant_id, log)):
+            return {}
+        model, scaler = router.read(lambda conn: train_model(conn, tenant_id, log))
+        if not model or not scaler:
+            return {task_id: 0.0 for task_id in task_ids}
+        return {
+            task_id: _score_task(connection, model, scaler, task_id, tenant_id, log)
+            for task_id in task_ids
+        }
+    finally:
+        connection.autocommit = autocommit
+        shard_map.putconn(shard, connection)
+
+
+def _connect_replica_quietly(dsn):
+    """后台线程连接从库：失败时返回None，不输出"""
+    try:
+        return psycopg2.connect(**_connection_params(dsn))
+    except OperationalError:
+        return None
+
+
+def _background_router(shard_map, connection, log):
+    """后台线程的读写分离路由：从库连接跨批次复用，主库连接和日志函数按批次替换"""
+    global _prediction_router
+    if _prediction_router is None:
+        # 从库配置只适用于单库部署
+        replica_dsns = get_replica_dsns() if shard_map.directory is None else []
+        _prediction_router = ConnectionRouter(
+            connection, replica_dsns, _connect_replica_quietly
+        )
+    _prediction_router.primary = connection
+    _prediction_router.log = log
+    return _prediction_router
+
+
+def submit_prediction(task_id, tenant_id=DEFAULT_TENANT):
+    """提交后台预测任务，立即返回；该租户已有排队中的预测时合并到其中"""
+    global _prediction_executor
+    with _predictions_lock:
+        pending = _pending_predictions.get(tenant_id)
+        if pending is not None:
+            pending[0].append(task_id)
+            return pending[1]
+        if _prediction_executor is None:
+            _prediction_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="prediction"
+            )
+        future = _prediction_executor.submit(_predict_in_background, tenant_id)
+        _pending_predictions[tenant_id] = ([task_id], future)
+        return future
+
+
+def report_finished_predictions():
+    """输出已完成的后台预测结果"""
+    with _predictions_lock:
+        finished = _finished_predictions[:]
+        _finished_predictions.clear()
+    for probabilities, messages in finished:
+        for message in messages:
+            print(message)
+        for task_id, probability in probabilities.items():
+            print(f"预测任务 {task_id} 按时完成的概率: {probability:.1%}")
+
+
+def shutdown_predictions():
+    """停止后台预测（取消排队中的任务，等待正在执行的任务结束）"""
+    global _prediction_executor, _prediction_router
+    if _prediction_executor is not None:
+        _prediction_executor.shutdown(wait=True, cancel_futures=True)
+        _prediction_executor = None
+    _pending_predictions.clear()
+    if _prediction_router is not None:
+        _prediction_router.close()
+        _prediction_router = None
+
+
+def view_predicted_probabilities(connection, tenant_id=DEFAULT_TENANT):
     """查看所有未完成任务的完成概率预测"""
     try:
         cursor = connection.cursor()
         cursor.execute("""
             SELECT id, title, priority, due_date, created_at 
             FROM tasks 
-            WHERE is_completed = FALSE AND due_date IS NOT NULL
+            WHERE tenant_id = %s AND is_completed = FALSE AND due_date IS NOT NULL
             ORDER BY due_date ASC
-        """)
+        """, (tenant_id,))
         
         tasks = cursor.fetchall()
         if not tasks:
             print("没有可预测的未完成任务!")
             return
             
-        model, scaler = train_model(connection)
+        model, scaler = train_model(connection, tenant_id)
         if not model or not scaler:
             return
             
@@ -423,45 +1393,982 @@ def view_predicted_probabilities(connection):
         print(f"查看预测概率时出错: {err}")
 
 
+# 未填写预估工时的未完成任务，排期时按该工时（小时）计算
+DEFAULT_TASK_HOURS = float(os.getenv("DEFAULT_TASK_HOURS", 1))
+
+
+def _gather(indptr, indices, nodes):
+    """批量取出CSR邻接数组中 nodes 的全部邻居，返回 (邻居, 对应的源节点)"""
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        empty = np.empty(0, dtype=indices.dtype)
+        return empty, empty
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return indices[np.repeat(starts, counts) + offsets], np.repeat(nodes, counts)
+
+
+class TaskGraph:
+    """任务依赖图：邻接关系以CSR紧凑数组保存，计算拓扑序、关键路径和最早/最晚完成时间
+
+    时间单位为小时（自Unix纪元起）。未完成任务最早从 now 开始，已完成任务耗时为0，
+    最晚完成时间受截止日期和后继任务约束，松弛时间为负表示预计逾期。
+    """
+
+    def __init__(self, task_ids, durations, due, dependents, dependencies, now):
+        order = np.argsort(task_ids, kind="stable")
+        self.task_ids = np.asarray(task_ids, dtype=np.int64)[order]
+        self.durations = np.asarray(durations, dtype=np.float64)[order]
+        self.due = np.asarray(due, dtype=np.float64)[order]
+        self.now = float(now)
+
+        # 边 src -> dst 表示 dst 依赖 src；忽略指向未知任务的边
+        dst = self._index(np.asarray(dependents, dtype=np.int64))
+        src = self._index(np.asarray(dependencies, dtype=np.int64))
+        valid = (src >= 0) & (dst >= 0)
+        src, dst = src[valid], dst[valid]
+        n = len(self.task_ids)
+        self.succ_ptr, self.succ = self._csr(src, dst, n)
+        self.pred_ptr, self.pred = self._csr(dst, src, n)
+
+        self._compute_earliest()
+        self._compute_latest()
+        self._sync()
+
+    def _index(self, ids):
+        """任务ID转换为数组下标（不存在时为-1）"""
+        if len(self.task_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.task_ids, ids), len(self.task_ids) - 1)
+        return np.where(self.task_ids[pos] == ids, pos, -1)
+
+    @staticmethod
+    def _csr(rows, cols, n):
+        """按行压缩存储邻接关系"""
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        indices = cols[np.argsort(rows, kind="stable")].astype(np.int32)
+        return indptr, indices
+
+    def _compute_earliest(self):
+        """分层拓扑排序（Kahn），同时计算最早完成时间
+
+        未完成任务最早从 now 开始，前置任务的完成时间也不早于 now，因此最早完成时间
+        总是 now 加上一段与 now 无关的工时；这里只保存这段相对工时（_elapsed）。
+        """
+        n = len(self.task_ids)
+        indegree = np.diff(self.pred_ptr)
+        start = np.zeros(n)
+        self._elapsed = np.empty(n)
+        self._levels = []
+
+        frontier = np.flatnonzero(indegree == 0)
+        while frontier.size:
+            self._levels.append(frontier)
+            self._elapsed[frontier] = start[frontier] + self.durations[frontier]
+            succ, src = _gather(self.succ_ptr, self.succ, frontier)
+            np.maximum.at(start, succ, self._elapsed[src])
+            np.subtract.at(indegree, succ, 1)
+            frontier = np.unique(succ[indegree[succ] == 0])
+
+        self.order = (
+            np.concatenate(self._levels) if self._levels else np.empty(0, np.int64)
+        )
+        if len(self.order) < n:
+            raise ValueError("任务依赖存在环，无法排期")
+        self.position = np.empty(n, dtype=np.int64)
+        self.position[self.order] = np.arange(n)
+        self._span = self._elapsed.max() if n else 0.0
+
+    def _bound(self, nodes):
+        """无后继约束时的最晚完成时间，分两列：截止日期，以及相对项目完成时间的偏移
+
+        有截止日期取截止日期，否则取项目完成时间（偏移为0）。最晚完成时间为
+        min(第一列, 项目完成时间 + 第二列)，两列都与 now 无关。
+        """
+        due = self.due[nodes]
+        finite = np.isfinite(due)
+        return np.stack(
+            (np.where(finite, due, np.inf), np.where(finite, np.inf, 0.0)), axis=-1
+        )
+
+    def _compute_latest(self):
+        """按拓扑逆序计算最晚完成时间"""
+        self._latest = self._bound(np.arange(len(self.task_ids)))
+        for level in reversed(self._levels):
+            preds, src = _gather(self.pred_ptr, self.pred, level)
+            latest_start = self._latest[src] - self.durations[src, None]
+            np.minimum.at(self._latest, preds, latest_start)
+
+    def _sync(self):
+        """由相对量按当前时间组合出最早/最晚完成时间和项目完成时间"""
+        self.horizon = self.now + self._span
+        self.earliest_finish = self.now + self._elapsed
+        self.latest_finish = np.minimum(
+            self._latest[:, 0], self.horizon + self._latest[:, 1]
+        )
+
+    @property
+    def slack(self):
+        """松弛时间（小时）"""
+        return self.latest_finish - self.earliest_finish
+
+    def topological_order(self):
+        """按拓扑序返回任务ID"""
+        return self.task_ids[self.order]
+
+    def critical_path(self):
+        """返回决定项目完成时间的关键路径（任务ID列表，按执行顺序）"""
+        return [int(self.task_ids[i]) for i in self.critical_nodes()]
+
+    def critical_nodes(self):
+        """关键路径上的节点下标（按执行顺序）"""
+        if len(self.task_ids) == 0:
+            return []
+        node = int(np.argmax(self.earliest_finish))
+        path = [node]
+        while True:
+            preds = self.pred[self.pred_ptr[node]:self.pred_ptr[node + 1]]
+            if preds.size == 0:
+                break
+            node = int(preds[np.argmax(self.earliest_finish[preds])])
+            if self.earliest_finish[node] <= self.now:
+                break  # 前置任务不再约束开始时间
+            path.append(node)
+        return path[::-1]
+
+    def set_now(self, now):
+        """更新当前时间：相对量与 now 无关，只需重新组合，不必沿依赖图重算"""
+        now = float(now)
+        if now == self.now:
+            return
+        self.now = now
+        self._sync()
+
+    def update_task(self, task_id, duration=None, due=None):
+        """单个任务工时或截止日期变化时，只沿受影响的上下游增量更新排期"""
+        index = int(self._index(np.array([task_id]))[0])
+        if index < 0:
+            raise KeyError(task_id)
+        if duration is not None:
+            self.durations[index] = duration
+        if due is not None:
+            self.due[index] = due
+
+        self._propagate_earliest(index)
+        self._span = self._elapsed.max()
+        self._propagate_latest(index)
+        self._sync()
+
+    def _propagate_earliest(self, index):
+        """按拓扑序向下游传播最早完成时间，未变化处停止"""
+        heap = [(self.position[index], index)]
+        queued = {index}
+        while heap:
+            _, node = heapq.heappop(heap)
+            queued.discard(node)
+            preds = self.pred[self.pred_ptr[node]:self.pred_ptr[node + 1]]
+            start = max(0.0, self._elapsed[preds].max()) if preds.size else 0.0
+            finish = start + self.durations[node]
+            if finish == self._elapsed[node]:
+                continue
+            self._elapsed[node] = finish
+            for succ in self.succ[self.succ_ptr[node]:self.succ_ptr[node + 1]]:
+                if succ not in queued:
+                    queued.add(succ)
+                    heapq.heappush(heap, (self.position[succ], succ))
+
+    def _propagate_latest(self, index):
+        """按拓扑逆序向上游传播最晚完成时间，未变化处停止"""
+        heap = [(-self.position[index], index)]
+        queued = {index}
+        while heap:
+            _, node = heapq.heappop(heap)
+            queued.discard(node)
+            succs = self.succ[self.succ_ptr[node]:self.succ_ptr[node + 1]]
+            finish = self._bound(node)
+            if succs.size:
+                latest_start = self._latest[succs] - self.durations[succs, None]
+                finish = np.minimum(finish, latest_start.min(axis=0))
+            # 起点任务的工时可能变化，其前置任务总需重新检查
+            if np.array_equal(finish, self._latest[node]) and node != index:
+                continue
+            self._latest[node] = finish
+            for pred in self.pred[self.pred_ptr[node]:self.pred_ptr[node + 1]]:
+                if pred not in queued:
+                    queued.add(pred)
+                    heapq.heappush(heap, (-self.position[pred], pred))
+
+
+# 排期所需的任务属性：剩余工时与截止时间（小时，自Unix纪元起）
+TASK_SCHEDULE_SQL = """
+    SELECT
+        id,
+        CASE WHEN is_completed THEN 0 ELSE COALESCE(estimated_hours, %s) END::float8,
+        COALESCE((EXTRACT(EPOCH FROM due_date) / 3600)::float8, 'Infinity'::float8)
+    FROM tasks
+    WHERE tenant_id = %s
+"""
+TASK_SCHEDULE_DTYPE = np.dtype([("id", "i8"), ("duration", "f8"), ("due", "f8")])
+
+
+# 依赖图的变更标记：最后修改时间、任务数和依赖版本号，任一变化说明缓存的依赖图已过期。
+# changed 统计 updated_at 晚于 %(seen)s 的任务数，用于确认期间只有本会话修改过任务。
+SCHEDULE_STATE_SQL = """
+    SELECT
+        (EXTRACT(EPOCH FROM CURRENT_TIMESTAMP) / 3600)::float8,
+        MAX(updated_at),
+        COUNT(*),
+        (SELECT version FROM task_dependency_versions WHERE tenant_id = %(tenant)s),
+        COUNT(*) FILTER (WHERE updated_at > %(seen)s)
+    FROM tasks
+    WHERE tenant_id = %(tenant)s
+"""
+
+
+def _schedule_state(cursor, tenant_id, seen=None):
+    """返回（数据库当前时间（纪元小时数）, 变更标记, 晚于 seen 修改的任务数）"""
+    cursor.execute(SCHEDULE_STATE_SQL, {"tenant": tenant_id, "seen": seen})
+    now, updated_at, count, version, changed = cursor.fetchone()
+    return now, (updated_at, count, version), changed
+
+
+def load_task_graph(connection, tenant_id=DEFAULT_TENANT):
+    """从数据库加载租户的全部任务和依赖，构建依赖图"""
+    try:
+        cursor = connection.cursor()
+        # 先读变更标记：加载期间的并发修改最多导致下次多重建一次，不会漏掉
+        now, marker, _ = _schedule_state(cursor, tenant_id)
+        cursor.execute(TASK_SCHEDULE_SQL, (DEFAULT_TASK_HOURS, tenant_id))
+        tasks = np.fromiter(cursor, dtype=TASK_SCHEDULE_DTYPE)
+        cursor.execute("""
+            SELECT d.task_id, d.depends_on_id
+            FROM task_dependencies d
+            JOIN tasks t ON t.id = d.task_id
+            WHERE t.tenant_id = %s
+        """, (tenant_id,))
+        edges = np.fromiter(
+            cursor, dtype=np.dtype([("task", "i8"), ("depends_on", "i8")])
+        )
+    except Error as err:
+        print(f"加载任务依赖失败: {err}")
+        return None
+    graph = TaskGraph(
+        tasks["id"], tasks["duration"], tasks["due"],
+        edges["task"], edges["depends_on"], now,
+    )
+    graph.marker = marker
+    return graph
+
+
+def current_task_graph(connection, graph, tenant_id=DEFAULT_TENANT):
+    """返回可用的依赖图：缓存未过期时只按当前时间平移排期，否则重新加载"""
+    if graph is None:
+        return load_task_graph(connection, tenant_id)
+    try:
+        now, marker, _ = _schedule_state(connection.cursor(), tenant_id)
+    except Error as err:
+        print(f"加载任务依赖失败: {err}")
+        return None
+    if marker != graph.marker:
+        # 其他会话修改了任务或依赖
+        return load_task_graph(connection, tenant_id)
+    graph.set_now(now)
+    return graph
+
+
+def refresh_task_schedule(connection, graph, task_id, tenant_id=DEFAULT_TENANT):
+    """任务被修改后，重新读取该任务属性并增量更新依赖图（失败时返回False）"""
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            TASK_SCHEDULE_SQL + " AND id = %s", (DEFAULT_TASK_HOURS, tenant_id, task_id)
+        )
+        row = cursor.fetchone()
+        _, marker, changed = _schedule_state(cursor, tenant_id, seen=graph.marker[0])
+    except Error as err:
+        print(f"刷新任务排期失败: {err}")
+        return False
+    # 期间只有这一个任务被修改、任务数和依赖都没变时，增量更新后的依赖图仍是最新的
+    if not row or changed != 1 or marker[1:] != graph.marker[1:]:
+        return False
+    try:
+        graph.update_task(row[0], duration=row[1], due=row[2])
+    except KeyError:
+        return False  # 依赖图中没有该任务（已过期），需要重建
+    graph.marker = marker
+    return True
+
+
+def add_dependency(connection, tenant_id=DEFAULT_TENANT, guard=_unguarded):
+    """添加任务依赖（插入前检测环）"""
+    task_id = input("请输入任务ID: ").strip()
+    depends_on_id = input("请输入它所依赖的任务ID: ").strip()
+    if not task_id.isdigit() or not depends_on_id.isdigit():
+        print("无效的任务ID!")
+        return False
+    if task_id == depends_on_id:
+        print("任务不能依赖自身!")
+        return False
+
+    with guard() as allowed:
+        if not allowed:
+            return False
+        try:
+            cursor = connection.cursor()
+            # 依赖只能在同一租户的任务之间建立
+            cursor.execute(
+                "SELECT COUNT(*) FROM tasks WHERE id IN (%s, %s) AND tenant_id = %s",
+                (task_id, depends_on_id, tenant_id),
+            )
+            if cursor.fetchone()[0] != 2:
+                connection.rollback()
+                print("未找到该任务ID!")
+                return False
+            # 串行化依赖写入，防止并发插入共同形成环
+            cursor.execute("LOCK TABLE task_dependencies IN SHARE ROW EXCLUSIVE MODE")
+            cursor.execute("""
+                WITH RECURSIVE upstream AS (
+                    SELECT depends_on_id FROM task_dependencies
+                    WHERE task_id = %(depends_on)s
+                    UNION
+                    SELECT d.depends_on_id
+                    FROM task_dependencies d
+                    JOIN upstream u ON d.task_id = u.depends_on_id
+                )
+                SELECT 1 FROM upstream WHERE depends_on_id = %(task)s LIMIT 1
+            """, {"task": task_id, "depends_on": depends_on_id})
+            if cursor.fetchone():
+                connection.rollback()
+                print("添加失败：该依赖会形成循环依赖!")
+                return False
+            cursor.execute("""
+                INSERT INTO task_dependencies (task_id, depends_on_id)
+                VALUES (%s, %s)
+                ON CONFLICT DO NOTHING
+            """, (task_id, depends_on_id))
+            connection.commit()
+            print("任务依赖添加成功!")
+            return True
+        except Error as err:
+            print(f"添加任务依赖失败: {err}")
+            connection.rollback()
+            return False
+
+
+def remove_dependency(connection, tenant_id=DEFAULT_TENANT, guard=_unguarded):
+    """删除任务依赖"""
+    task_id = input("请输入任务ID: ").strip()
+    depends_on_id = input("请输入要解除依赖的任务ID: ").strip()
+    if not task_id.isdigit() or not depends_on_id.isdigit():
+        print("无效的任务ID!")
+        return False
+
+    with guard() as allowed:
+        if not allowed:
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""
+                DELETE FROM task_dependencies d
+                USING tasks t
+                WHERE d.task_id = %s AND d.depends_on_id = %s
+                AND t.id = d.task_id AND t.tenant_id = %s
+            """, (task_id, depends_on_id, tenant_id))
+            connection.commit()
+            if cursor.rowcount > 0:
+                print("任务依赖删除成功!")
+                return True
+            print("未找到该依赖关系!")
+        except Error as err:
+            print(f"删除任务依赖失败: {err}")
+            connection.rollback()
+    return False
+
+
+def _format_hours(hours):
+    """纪元小时数转为本地时间字符串"""
+    if not np.isfinite(hours):
+        return "无"
+    return datetime.datetime.fromtimestamp(hours * 3600).strftime("%Y-%m-%d %H:%M")
+
+
+def view_schedule(connection, graph, tenant_id=DEFAULT_TENANT):
+    """查看关键路径、预计逾期任务和阻塞其他任务的逾期任务"""
+    path = graph.critical_nodes()
+    slack = graph.slack
+    incomplete = graph.durations > 0
+    at_risk = np.flatnonzero(incomplete & (slack < 0))
+    at_risk = at_risk[np.argsort(slack[at_risk])][:20]
+    dependents = np.diff(graph.succ_ptr)
+    blocking = np.flatnonzero(incomplete & (graph.due < graph.now) & (dependents > 0))
+    blocking = blocking[np.argsort(-dependents[blocking])][:20]
+
+    shown = {int(graph.task_ids[i]) for i in np.concatenate((path, at_risk, blocking))}
+    titles = {}
+    if shown:
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT id, title FROM tasks WHERE id = ANY(%s) AND tenant_id = %s",
+                (list(shown), tenant_id),
+            )
+            titles = dict(cursor.fetchall())
+        except Error as err:
+            print(f"查询任务标题失败: {err}")
+
+    print("\n" + "=" * 60)
+    print(f"排期任务数: {len(graph.task_ids)}, 预计全部完成: {_format_hours(graph.horizon)}")
+    print("-" * 60)
+    print("关键路径:")
+    for i in path:
+        task_id = int(graph.task_ids[i])
+        print(f"  [{task_id}] {titles.get(task_id, '')} "
+              f"最早完成: {_format_hours(graph.earliest_finish[i])} "
+              f"最晚完成: {_format_hours(graph.latest_finish[i])}")
+    print("-" * 60)
+    print("预计逾期的任务:")
+    for i in at_risk:
+        task_id = int(graph.task_ids[i])
+        print(f"  [{task_id}] {titles.get(task_id, '')} "
+              f"最早完成: {_format_hours(graph.earliest_finish[i])} "
+              f"最晚完成: {_format_hours(graph.latest_finish[i])} "
+              f"延误: {-slack[i]:.1f} 小时")
+    print("-" * 60)
+    print("阻塞其他任务的逾期任务:")
+    for i in blocking:
+        task_id = int(graph.task_ids[i])
+        print(f"  [{task_id}] {titles.get(task_id, '')} "
+              f"截止: {_format_hours(graph.due[i])} 直接阻塞 {dependents[i]} 个任务")
+    print("-" * 60)
+
+
+def manage_dependencies(connection, graph=None, tenant_id=DEFAULT_TENANT,
+                        guard=_unguarded):
+    """任务依赖与排期菜单，返回（可能已失效或重建的）依赖图
+
+    guard 只用于添加/删除依赖的写入，查看排期不需要写保护。
+    """
+    print("\n依赖选项:")
+    print("1. 添加任务依赖")
+    print("2. 删除任务依赖")
+    print("3. 查看关键路径与排期")
+
+    choice = input("请选择操作 (1-3): ").strip()
+    if choice == '1':
+        return None if add_dependency(connection, tenant_id, guard) else graph
+    if choice == '2':
+        return None if remove_dependency(connection, tenant_id, guard) else graph
+    if choice == '3':
+        try:
+            graph = current_task_graph(connection, graph, tenant_id)
+        except ValueError as err:
+            print(err)
+            return None
+        if graph is not None:
+            view_schedule(connection, graph, tenant_id)
+        return graph
+    print("无效的选择!")
+    return graph
+
+
+WEEKLY_STATS_COLUMNS = """
+    week_start, priority, total, completed, labeled, on_time, late, lateness_hours,
+    feature_rows, feature_success, hours_available_sum
+"""
+
+# 按租户、周（截止日期所在周，无截止日期按创建时间）和优先级的聚合：已结束的周直接读缓存，
+# 其余周从 tasks 重新聚合，并把新结束的周写入缓存。各报表在 weekly_stats 之上
+# 再做分组/窗口计算，整个报表一次往返完成。任务的增删改由触发器使所在周及之后的缓存失效。
+WEEKLY_STATS_CTE = f"""
+    WITH cached AS (
+        SELECT {WEEKLY_STATS_COLUMNS} FROM report_weekly_stats
+        WHERE tenant_id = %(tenant)s
+        AND week_start < date_trunc('week', CURRENT_TIMESTAMP)
+    ),
+    fresh AS (
+        SELECT
+            date_trunc('week', COALESCE(due_date, created_at)) AS week_start,
+            priority,
+            COUNT(*) AS total,
+            COUNT(*) FILTER (WHERE is_completed) AS completed,
+            COUNT(success) AS labeled,
+            COUNT(*) FILTER (WHERE success = 1) AS on_time,
+            COUNT(*) FILTER (WHERE is_completed AND completed_at > due_date) AS late,
+            COALESCE(
+                SUM((EXTRACT(EPOCH FROM (completed_at - due_date)) / 3600)::float8)
+                FILTER (WHERE is_completed AND completed_at > due_date), 0
+            ) AS lateness_hours,
+            COUNT(*) FILTER (WHERE success IS NOT NULL AND hours_available > 0)
+                AS feature_rows,
+            COUNT(*) FILTER (WHERE success = 1 AND hours_available > 0)
+                AS feature_success,
+            COALESCE(SUM(hours_available)
+                FILTER (WHERE success IS NOT NULL AND hours_available > 0), 0)
+                AS hours_available_sum
+        FROM ({TASK_FEATURES_SQL}) AS features
+        -- 下界来自子查询，规划时未知；加上恒真的上界后按范围条件估算行数，
+        -- 从而走 idx_tasks_tenant_week 索引只扫描未缓存的周
+        WHERE COALESCE(due_date, created_at) >= COALESCE(
+            (SELECT MAX(week_start) + INTERVAL '1 week' FROM cached), '-infinity'
+        )
+        AND COALESCE(due_date, created_at) <= 'infinity'
+        GROUP BY 1, 2
+    ),
+    stored AS (
+        INSERT INTO report_weekly_stats (tenant_id, {WEEKLY_STATS_COLUMNS})
+        SELECT %(tenant)s, {WEEKLY_STATS_COLUMNS} FROM fresh
+        WHERE week_start < date_trunc('week', CURRENT_TIMESTAMP)
+        ON CONFLICT DO NOTHING
+    ),
+    weekly_stats AS (
+        SELECT {WEEKLY_STATS_COLUMNS} FROM cached
+        UNION ALL
+        SELECT {WEEKLY_STATS_COLUMNS} FROM fresh
+    )
+"""
+
+WEEKLY_STATS_LOCK_SQL = (
+    "SELECT pg_advisory_xact_lock(hashtext('report_weekly_stats:' || %(tenant)s))"
+)
+
+# 报表：(标题, 查询, [(列名, 格式)])
+REPORTS = {
+    '1': ("各优先级完成率", """
+        SELECT
+            priority,
+            SUM(total),
+            SUM(completed)::float8 / NULLIF(SUM(total), 0),
+            SUM(on_time)::float8 / NULLIF(SUM(labeled), 0)
+        FROM weekly_stats
+        GROUP BY priority
+        ORDER BY priority
+    """, [("优先级", "{}"), ("任务数", "{}"), ("完成率", "{:.1%}"), ("按时率", "{:.1%}")]),
+    '2': ("每周按时完成率", """
+        SELECT
+            week_start::date,
+            SUM(labeled),
+            SUM(on_time)::float8 / NULLIF(SUM(labeled), 0),
+            SUM(SUM(on_time)::float8) OVER w / NULLIF(SUM(SUM(labeled)) OVER w, 0)
+        FROM weekly_stats
+        GROUP BY week_start
+        WINDOW w AS (ORDER BY week_start)
+        ORDER BY week_start
+    """, [("周", "{}"), ("已定结果", "{}"), ("按时率", "{:.1%}"), ("累计按时率", "{:.1%}")]),
+    '3': ("每周平均逾期时长", """
+        SELECT
+            week_start::date,
+            SUM(late),
+            SUM(lateness_hours) / NULLIF(SUM(late), 0),
+            SUM(SUM(lateness_hours)) OVER () / NULLIF(SUM(SUM(late)) OVER (), 0)
+        FROM weekly_stats
+        GROUP BY week_start
+        HAVING SUM(late) > 0
+        ORDER BY week_start
+    """, [("周", "{}"), ("逾期完成", "{}"), ("平均逾期(小时)", "{:.1f}"),
+          ("总体平均(小时)", "{:.1f}")]),
+    '4': ("模型特征漂移（与 train_model 相同的优先级/可用小时特征）", """
+        SELECT
+            week_start::date,
+            SUM(feature_rows),
+            SUM(priority * feature_rows)::float8 / NULLIF(SUM(feature_rows), 0),
+            SUM(hours_available_sum) / NULLIF(SUM(feature_rows), 0),
+            SUM(feature_success)::float8 / NULLIF(SUM(feature_rows), 0),
+            SUM(hours_available_sum) / NULLIF(SUM(feature_rows), 0)
+                - SUM(SUM(hours_available_sum)) OVER ()
+                / NULLIF(SUM(SUM(feature_rows)) OVER (), 0)
+        FROM weekly_stats
+        GROUP BY week_start
+        HAVING SUM(feature_rows) > 0
+        ORDER BY week_start
+    """, [("周", "{}"), ("样本数", "{}"), ("平均优先级", "{:.2f}"),
+          ("平均可用小时", "{:.1f}"), ("按时率", "{:.1%}"), ("可用小时偏离均值", "{:+.1f}")]),
+}
+
+
+def run_report(connection, key, tenant_id=DEFAULT_TENANT):
+    """执行租户的一个统计报表（单次数据库往返）并输出"""
+    title, query, columns = REPORTS[key]
+    try:
+        cursor = connection.cursor()
+        # 等待进行中的任务写入提交（其触发器持有共享锁），报表语句的快照包含这些写入
+        cursor.execute(
+            WEEKLY_STATS_LOCK_SQL + ";" + WEEKLY_STATS_CTE + query,
+            {"tenant": tenant_id},
+        )
+        rows = cursor.fetchall()
+        connection.commit()  # 保存新结束周的缓存
+    except Error as err:
+        print(f"生成报表失败: {err}")
+        connection.rollback()
+        return
+
+    print("\n" + "=" * 60)
+    print(title)
+    print("-" * 60)
+    if not rows:
+        print("暂无数据!")
+        return
+    print(" | ".join(name for name, _ in columns))
+    for row in rows:
+        print(" | ".join(
+            "-" if value is None else fmt.format(value)
+            for value, (_, fmt) in zip(row, columns)
+        ))
+    print("-" * 60)
+
+
+def view_reports(connection, tenant_id=DEFAULT_TENANT):
+    """统计报表菜单"""
+    print("\n报表选项:")
+    for key, (title, _, _) in REPORTS.items():
+        print(f"{key}. {title}")
+
+    choice = input(f"请选择报表 (1-{len(REPORTS)}): ").strip()
+    if choice not in REPORTS:
+        print("无效的选择!")
+        return
+    run_report(connection, choice, tenant_id)
+
+
+TENANT_TASK_COLUMNS = """
+    title, description, priority, is_completed, due_date, created_at, completed_at,
+    estimated_hours
+"""
+
+
+def _delete_tenant_rows(cursor, tenant_id):
+    """删除租户在一个分片上的任务（依赖级联删除）、删除记录和报表缓存"""
+    cursor.execute("DELETE FROM tasks WHERE tenant_id = %s", (tenant_id,))
+    cursor.execute("DELETE FROM task_deletions WHERE tenant_id = %s", (tenant_id,))
+    cursor.execute("DELETE FROM report_weekly_stats WHERE tenant_id = %s", (tenant_id,))
+
+
+def _copy_tenant(source, target, tenant_id):
+    """把租户的任务、依赖和删除记录原样复制到目标分片（保留任务ID，不提交），返回任务数
+
+    各分片的任务ID区间互不重叠，保留原ID不会冲突，会话中的任务ID和训练快照
+    在迁移后仍然有效；删除记录一并复制，快照的增量查询才能剔除已删除的任务。
+    """
+    src = source.cursor()
+    src.execute(
+        f"SELECT id, {TENANT_TASK_COLUMNS} FROM tasks WHERE tenant_id = %s ORDER BY id",
+        (tenant_id,),
+    )
+    tasks = src.fetchall()
+    src.execute("""
+        SELECT d.task_id, d.depends_on_id
+        FROM task_dependencies d
+        JOIN tasks t ON t.id = d.task_id
+        WHERE t.tenant_id = %s
+    """, (tenant_id,))
+    edges = src.fetchall()
+    src.execute(
+        "SELECT task_id, tenant_id, deleted_at FROM task_deletions "
+        "WHERE tenant_id = %s",
+        (tenant_id,),
+    )
+    deletions = src.fetchall()
+
+    # 先删除上次中断的迁移留在目标分片上的数据，复制可以重复执行
+    dst = target.cursor()
+    _delete_tenant_rows(dst, tenant_id)
+    if tasks:
+        execute_values(
+            dst,
+            f"INSERT INTO tasks (id, tenant_id, {TENANT_TASK_COLUMNS}) VALUES %s",
+            [(task[0], tenant_id) + tuple(task[1:]) for task in tasks],
+        )
+    if edges:
+        execute_values(
+            dst,
+            "INSERT INTO task_dependencies (task_id, depends_on_id) VALUES %s",
+            edges,
+        )
+    if deletions:
+        execute_values(
+            dst,
+            "INSERT INTO task_deletions (task_id, tenant_id, deleted_at) VALUES %s",
+            deletions,
+        )
+    return len(tasks)
+
+
+def _copy_between_shards(shard_map, source, target, tenant_id):
+    """在一个目标分片事务中复制租户数据，返回任务数（失败时返回None，目标分片不变）"""
+    source_conn = shard_map.getconn(source)
+    target_conn = shard_map.getconn(target)
+    try:
+        if not source_conn or not target_conn:
+            return None
+        try:
+            copied = _copy_tenant(source_conn, target_conn, tenant_id)
+            target_conn.commit()
+            source_conn.rollback()
+        except Error as err:
+            print(f"迁移租户失败: {err}")
+            target_conn.rollback()
+            source_conn.rollback()
+            return None
+        return copied
+    finally:
+        if source_conn:
+            shard_map.putconn(source, source_conn)
+        if target_conn:
+            shard_map.putconn(target, target_conn)
+
+
+def _cleanup_shard(shard_map, shard, tenant_id):
+    """删除租户在分片上的数据（失败时返回False）"""
+    connection = shard_map.getconn(shard)
+    if not connection:
+        return False
+    try:
+        _delete_tenant_rows(connection.cursor(), tenant_id)
+        connection.commit()
+        return True
+    except Error as err:
+        print(f"清理分片 {shard} 上的租户数据失败: {err}")
+        connection.rollback()
+        return False
+    finally:
+        shard_map.putconn(shard, connection)
+
+
+def move_tenant(shard_map, tenant_id, target):
+    """在线迁移租户到目标分片：迁移期间该租户写入被拒绝，读取和其他租户不受影响
+
+    迁移进度记录在租户目录中：中断后用相同参数重新执行即从中断处继续，
+    切换目录之前也可以用 abort_move 中止。
+    """
+    if shard_map.directory is None:
+        print("未配置多分片（SHARD_DSNS），无需迁移!")
+        return False
+    if target not in shard_map.shard_dsns:
+        print(f"未知的分片: {target}")
+        return False
+    if shard_map.shard_for(tenant_id) is None:
+        return False
+    state = shard_map.move_state(tenant_id)
+    if state is None:
+        return False
+    shard, moving, source, move_target = state
+
+    if not moving and source:
+        # 上次迁移已切换目录，但源分片还没有清理完
+        if not _cleanup_shard(shard_map, source, tenant_id):
+            print("源分片仍未清理完，请稍后重新执行迁移命令!")
+            return False
+        shard_map.update_placement(tenant_id)
+        if shard == target:
+            print(f"租户 {tenant_id} 已迁移到 {target}，源分片 {source} 清理完成")
+            return True
+    if moving and move_target != target:
+        print(f"租户 {tenant_id} 正在迁移到分片 {move_target}，"
+              f"请用相同参数继续或先中止该迁移!")
+        return False
+    if not moving and shard == target:
+        print(f"租户 {tenant_id} 已在分片 {target} 上!")
+        return False
+
+    source = shard
+    if moving:
+        print(f"继续未完成的迁移: {source} -> {target}")
+    # 标记迁移中：会等待该租户正在进行的写操作结束，之后的写操作被拒绝
+    elif not shard_map.update_placement(tenant_id, moving=True, move_target=target):
+        return False
+
+    copied = _copy_between_shards(shard_map, source, target, tenant_id)
+    if copied is None:
+        # 复制在一个事务中完成，失败时目标分片没有残留，直接恢复写入
+        shard_map.update_placement(tenant_id)
+        return False
+
+    # 切换目录后恢复写入，源分片的数据随后清理；任一步骤中断都可以重新执行继续
+    if not shard_map.update_placement(tenant_id, shard=target, move_source=source):
+        print("租户目录切换失败，租户仍处于迁移中：可重新执行相同命令继续，"
+              "或使用 --abort 中止!")
+        return False
+    if not _cleanup_shard(shard_map, source, tenant_id):
+        print("源分片数据未清理完，请重新执行相同命令完成清理!")
+        return False
+    shard_map.update_placement(tenant_id)
+    print(f"租户 {tenant_id} 已从 {source} 迁移到 {target}，共 {copied} 个任务")
+    return True
+
+
+def abort_move(shard_map, tenant_id):
+    """中止尚未切换目录的迁移：删除已复制到目标分片的数据并恢复写入"""
+    if shard_map.directory is None:
+        print("未配置多分片（SHARD_DSNS），无需迁移!")
+        return False
+    state = shard_map.move_state(tenant_id)
+    if state is None:
+        return False
+    _, moving, source, target = state
+    if not moving:
+        if source:
+            print("迁移已切换目录，无法中止，请重新执行迁移命令完成源分片清理!")
+        else:
+            print(f"租户 {tenant_id} 没有进行中的迁移!")
+        return False
+    if not _cleanup_shard(shard_map, target, tenant_id):
+        # 残留数据不影响使用，下次迁移到该分片时会先删除
+        print(f"分片 {target} 上已复制的数据未能清理，下次迁移时会先删除")
+    if not shard_map.update_placement(tenant_id):
+        return False
+    print(f"已中止租户 {tenant_id} 到分片 {target} 的迁移")
+    return True
+
+
 def main():
     """主函数"""
-    connection = create_connection()
+    shard_map = get_shard_map()
+    if not shard_map:
+        print("无法连接到数据库，程序退出!")
+        return
+
+    # 初始化各分片的表结构
+    for shard in shard_map.shard_dsns:
+        shard_conn = shard_map.getconn(shard)
+        if not shard_conn:
+            print("无法连接到数据库，程序退出!")
+            shard_map.close()
+            return
+        initialize_table(shard_conn)
+        shard_map.reserve_id_range(shard, shard_conn)
+        shard_map.putconn(shard, shard_conn)
+
+    # 命令行方式：python task.py move-tenant <租户> <分片> 在线迁移租户（中断后重新执行
+    # 即可继续），python task.py move-tenant <租户> --abort 中止未切换目录的迁移
+    if len(sys.argv) > 1 and sys.argv[1] == "move-tenant":
+        if len(sys.argv) == 4 and sys.argv[3] == "--abort":
+            abort_move(shard_map, sys.argv[2])
+        elif len(sys.argv) == 4:
+            move_tenant(shard_map, sys.argv[2], sys.argv[3])
+        else:
+            print("用法: python task.py move-tenant <租户> <分片|--abort>")
+        shard_map.close()
+        return
+
+    # 当前会话的租户（团队），所有操作只在该租户所在分片上进行
+    tenant_id = os.getenv("TASK_TENANT", DEFAULT_TENANT)
+    shard = shard_map.shard_for(tenant_id)
+    connection = shard_map.getconn(shard) if shard else None
     if not connection:
         print("无法连接到数据库，程序退出!")
+        shard_map.close()
         return
 
-    # 初始化表结构
-    initialize_table(connection)
+    # 只读查询（列表、训练、预测）分发到从库，写操作留在主库；从库配置只适用于单库部署
+    replica_dsns = [] if shard_map.directory is not None else get_replica_dsns()
+    if shard_map.directory is not None and get_replica_dsns():
+        print("提示: 已配置 SHARD_DSNS，DB_REPLICA_DSNS 从库配置不生效")
+    router = ConnectionRouter(connection, replica_dsns)
+    # 依赖图缓存：任务修改时增量更新，任务或依赖增删时失效重建
+    schedule_graph = None
+
+    def close_all():
+        shutdown_predictions()
+        router.close()
+        shard_map.putconn(shard, connection)
+        shard_map.close()
+
+    @contextlib.contextmanager
+    def write_guard():
+        """租户写保护（租户迁移中或已迁走时不允许写入），只包住写操作的SQL"""
+        try:
+            with shard_map.write_guard(tenant_id, shard) as allowed:
+                yield allowed
+        finally:
+            # 读己之写窗口从写操作提交之后开始计算
+            router.mark_written()
+
+    def follow_tenant():
+        """每次操作前确认租户仍在当前分片；会话期间被迁走时切换到新分片的连接"""
+        nonlocal shard, connection, router, schedule_graph
+        current = shard_map.current_shard(tenant_id)
+        if current is None or current == shard:
+            return
+        new_connection = shard_map.getconn(current)
+        if not new_connection:
+            print("租户已迁移到其他分片，但无法连接新分片，请重新启动程序!")
+            return
+        router.close()
+        shard_map.putconn(shard, connection)
+        shard, connection = current, new_connection
+        router = ConnectionRouter(connection, replica_dsns)
+        schedule_graph = None
+        print(f"租户已迁移到分片 {shard}，已切换连接")
+
+    # 命令行方式：python task.py snapshot [路径] 导出训练数据快照
+    # （在主库上导出，避免从库复制延迟导致水位之前的数据缺失）
+    if len(sys.argv) > 1 and sys.argv[1] == "snapshot":
+        export_training_snapshot(
+            connection, sys.argv[2] if len(sys.argv) > 2 else None, tenant_id
+        )
+        close_all()
+        return
+    # 命令行方式：python task.py report [编号] 输出统计报表（默认全部）
+    # （报表会写入缓存，因此在主库上执行）
+    if len(sys.argv) > 1 and sys.argv[1] == "report":
+        for key in sys.argv[2:] or REPORTS:
+            if key in REPORTS:
+                run_report(connection, key, tenant_id)
+            else:
+                print(f"无效的报表编号: {key}")
+        close_all()
+        return
 
     print("=" * 50)
     print("欢迎使用命令行任务管理系统")
+    print(f"当前团队: {tenant_id}")
     print("=" * 50)
 
     while True:
+        report_finished_predictions()
         print("\n功能菜单:")
         print("1. 添加新任务")
         print("2. 查看任务列表")
         print("3. 更新任务状态")
         print("4. 删除任务")
-        print("5. 退出系统")
+        print("5. 任务依赖与排期")
+        print("6. 查看统计报表")
+        print("7. 退出系统")
 
-        choice = input("请选择功能 (1-5): ").strip()
+        choice = input("请选择功能 (1-7): ").strip()
+        if choice in ('1', '2', '3', '4', '5', '6'):
+            follow_tenant()
 
         if choice == '1':
-            add_task(connection)
+            add_task(router.writer(), tenant_id, guard=write_guard)
+            schedule_graph = None
         elif choice == '2':
-            view_tasks(connection)
+            view_tasks(router, tenant_id)
         elif choice == '3':
-            update_task(connection)
+            updated_id = update_task(router.writer(), tenant_id, guard=write_guard)
+            if updated_id and schedule_graph is not None:
+                if not refresh_task_schedule(
+                    router.writer(), schedule_graph, updated_id, tenant_id
+                ):
+                    schedule_graph = None
         elif choice == '4':
-            delete_task(connection)
+            delete_task(router.writer(), tenant_id, guard=write_guard)
+            schedule_graph = None
         elif choice == '5':
+            schedule_graph = manage_dependencies(
+                router.writer(), schedule_graph, tenant_id, guard=write_guard
+            )
+        elif choice == '6':
+            view_reports(router.writer(), tenant_id)
+        elif choice == '7':
             print("感谢使用，再见!")
             break
         else:
             print("无效的选择，请重新输入!")
 
-    connection.close()
+    close_all()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
 import pytest
-from datetime import datetime
+import contextlib
+import threading
+import numpy as np
+from datetime import datetime, timezone
 from unittest.mock import MagicMock
+import psycopg2
 # from src.task import task  # 替换为你的主程序文件名（无.py）
 import sys
 import os
@@ -15,6 +19,24 @@ def print_step(step, message):
     print(f"{'='*(42 + len(step))}\n")
 
 
+@pytest.fixture
+def pg_conn():
+    """真实PostgreSQL连接（设置 TEST_DATABASE_DSN 时运行，会重建项目表；否则跳过）"""
+    dsn = os.getenv("TEST_DATABASE_DSN")
+    if not dsn:
+        pytest.skip("未设置 TEST_DATABASE_DSN")
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor()
+    cursor.execute(
+        "DROP TABLE IF EXISTS task_dependencies, task_dependency_versions, "
+        "report_weekly_stats, task_deletions, tasks"
+    )
+    conn.commit()
+    task.initialize_table(conn)
+    yield conn
+    conn.close()
+
+
 @pytest.fixture
 def fresh_mock_db():
     """每次调用都生成全新的模拟连接和游标"""
@@ -49,6 +71,11 @@ def test_full_task_flow(fresh_mock_db, monkeypatch, capsys):
         return response
 
     monkeypatch.setattr('builtins.input', add_input)
+    submitted = []
+    monkeypatch.setattr(
+        task, "submit_prediction",
+        lambda task_id, tenant_id: submitted.append((task_id, tenant_id)),
+    )
 
     # 执行添加
     task.add_task(mock_conn)
@@ -61,6 +88,7 @@ def test_full_task_flow(fresh_mock_db, monkeypatch, capsys):
     assert "任务添加成功! 任务ID: 1" in captured.out, "添加任务验证失败"
     assert "INSERT INTO tasks" in mock_cursor.execute.call_args[0][0], "SQL语句不正确"
     assert "RETURNING id" in mock_cursor.execute.call_args[0][0], "缺少RETURNING子句"
+    assert submitted == [(1, "default")], "未提交后台预测"
     print_step("步骤1结果", "任务添加测试通过 ✅")
 
     # ------------------------------
@@ -155,7 +183,7 @@ def test_full_task_flow(fresh_mock_db, monkeypatch, capsys):
 
     assert "任务删除成功!" in captured.out, "删除任务失败"
     mock_cursor.execute.assert_called_once_with(
-        "DELETE FROM tasks WHERE id = %s", ("1",)
+        "DELETE FROM tasks WHERE id = %s AND tenant_id = %s", ("1", "default")
     )
     print_step("步骤4结果", "任务删除测试通过 ✅")
 
@@ -164,5 +192,539 @@ def test_full_task_flow(fresh_mock_db, monkeypatch, capsys):
     print("="*50 + "\n")
 
 
+def test_router_read_write_split(monkeypatch):
+    """读写分离：读请求轮询从库，故障从库回退，写后读走主库"""
+    primary = MagicMock()
+    replicas = {}
+
+    def fake_connect(dsn):
+        conn = MagicMock()
+        conn.closed = 0
+        if dsn == "replica-down":
+            conn.cursor.return_value.execute.side_effect = task.Error("down")
+        replicas[dsn] = conn
+        return conn
+
+    router = task.ConnectionRouter(primary, ["replica-a", "replica-b"], fake_connect)
+
+    # 从库轮询
+    assert router.reader() is replicas["replica-a"]
+    assert router.reader() is replicas["replica-b"]
+    assert router.reader() is replicas["replica-a"]
+    replicas["replica-a"].set_session.assert_called_once_with(
+        readonly=True, autocommit=True
+    )
+
+    # 取得主库连接本身不固定读请求，写操作提交后才固定到主库（读己之写）
+    assert router.writer() is primary
+    assert router.reader() is not primary
+    router.mark_written()
+    assert router.reader() is primary
+    monkeypatch.setattr(task, "READ_YOUR_WRITES_SECONDS", 0)
+    router.mark_written()
+    assert router.reader() is not primary
+
+    # 从库在健康检查间隔内失效：查询失败后标记不可用，并在主库上重试
+    def fetch(conn):
+        if conn is not primary:
+            raise task.OperationalError("server closed the connection")
+        return [("ok",)]
+
+    assert router.read(fetch) == [("ok",)]
+    replicas["replica-b"].close.assert_called_once()
+    assert router.reader() is replicas["replica-a"]
+    assert router.reader() is replicas["replica-a"]  # replica-b 暂不使用
+
+    # 所有从库都不可用时回退到主库
+    router = task.ConnectionRouter(primary, ["replica-down"], fake_connect)
+    assert router.reader() is primary
+    replicas["replica-down"].close.assert_called_once()
+
+
+def test_training_snapshot_with_delta(tmp_path):
+    """训练数据快照：导出后内存映射读取，并只从数据库补充导出之后的增量"""
+    path = str(tmp_path / "snapshot.npy")
+    watermark = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    changed_since = datetime(2024, 5, 31, tzinfo=timezone.utc)
+
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value
+    mock_cursor.fetchone.return_value = (watermark, changed_since)
+    mock_cursor.__iter__.return_value = iter([(1, 1, 24.0, 1), (2, 3, 48.0, 0)])
+    assert task.export_training_snapshot(mock_conn, path) == watermark
+
+    data, loaded_watermark, loaded_changed_since = task.load_training_snapshot(path)
+    assert isinstance(data, np.memmap)
+    assert loaded_watermark == watermark
+    assert loaded_changed_since == changed_since
+    assert list(data["priority"]) == [1, 3]
+
+    # 增量：任务2被修改后不再有标签，任务3被删除（快照中没有），任务5新产生标签
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value
+    mock_cursor.fetchall.return_value = [
+        (2, 3, -5.0, None), (3, None, None, None), (5, 2, 12.0, 0),
+    ]
+    data = task.load_training_data(mock_conn, path)
+    sql, params = mock_cursor.execute.call_args[0]
+    assert "updated_at >= %(changed_since)s" in sql
+    assert "task_deletions" in sql
+    assert params == {
+        "tenant": "default", "watermark": watermark, "changed_since": changed_since,
+    }
+    assert list(data["id"]) == [1, 5]
+    assert list(data["success"]) == [1, 0]
+
+    # 快照文件损坏时按没有快照处理，从数据库全量加载
+    with open(str(tmp_path / "snapshot.meta.json"), "w", encoding="utf-8") as f:
+        f.write('{"watermark": ')
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value
+    mock_cursor.__iter__.return_value = iter([(1, 1, 24.0, 1)])
+    data = task.load_training_data(mock_conn, path, log=lambda message: None)
+    assert mock_cursor.execute.call_args[0][0] == task.TRAINING_FEATURES_SQL
+    assert list(data["id"]) == [1]
+
+    # 租户标识不能让快照写到目标目录之外
+    assert os.path.dirname(task._snapshot_path("../x")) == os.path.dirname(
+        task._snapshot_path("team-a")
+    )
+
+
+def test_training_snapshot_delta_on_postgres(pg_conn, tmp_path):
+    """真实数据库：快照之后补录的过期任务、改到过去的截止日期、延迟提交的完成时间都能补充"""
+    path = str(tmp_path / "snapshot.npy")
+    cursor = pg_conn.cursor()
+    cursor.execute("""
+        INSERT INTO tasks (title, priority, due_date, created_at, is_completed, completed_at)
+        VALUES ('a', 1, now() - interval '1 day', now() - interval '3 days',
+                TRUE, now() - interval '2 days'),
+               ('b', 2, now() + interval '3 days', now() - interval '1 day', FALSE, NULL),
+               ('c', 3, now() + interval '3 days', now() - interval '1 day', FALSE, NULL)
+        RETURNING id
+    """)
+    a, b, c = (row[0] for row in cursor.fetchall())
+    pg_conn.commit()
+    assert task.export_training_snapshot(pg_conn, path) is not None
+
+    # 另一个会话在导出前开始事务、导出后才提交：完成时间早于水位
+    late_conn = psycopg2.connect(os.environ["TEST_DATABASE_DSN"])
+    late_cursor = late_conn.cursor()
+    late_cursor.execute("SELECT 1")
+    # 快照后补录一个已过期的任务，并把任务b的截止日期改到过去
+    cursor.execute("""
+        INSERT INTO tasks (title, priority, due_date, created_at)
+        VALUES ('d', 4, now() - interval '1 hour', now() - interval '2 days')
+        RETURNING id
+    """)
+    d = cursor.fetchone()[0]
+    cursor.execute(
+        "UPDATE tasks SET due_date = now() - interval '1 hour' WHERE id = %s", (b,)
+    )
+    cursor.execute("DELETE FROM tasks WHERE id = %s", (a,))
+    pg_conn.commit()
+    late_cursor.execute(
+        "UPDATE tasks SET is_completed = TRUE, completed_at = now() WHERE id = %s", (c,)
+    )
+    late_conn.commit()
+    late_conn.close()
+    cursor.execute(
+        "UPDATE tasks SET due_date = now() - interval '1 minute' WHERE id = %s", (c,)
+    )
+    pg_conn.commit()
+
+    data = task.load_training_data(pg_conn, path)
+    cursor.execute(task.TRAINING_FEATURES_SQL, {"tenant": task.DEFAULT_TENANT})
+    expected = {row[0]: row[3] for row in cursor.fetchall()}
+    assert dict(zip(data["id"].tolist(), data["success"].tolist())) == expected
+    assert set(expected) == {b, c, d}
+
+    # 重新导出后，之前的删除记录不再需要
+    assert task.export_training_snapshot(pg_conn, path) is not None
+    cursor.execute("SELECT COUNT(*) FROM task_deletions")
+    assert cursor.fetchone()[0] == 0
+
+
+def test_prediction_runs_in_background(fresh_mock_db, monkeypatch, capsys):
+    """添加任务后预测在后台线程完成，同一租户排队中的请求只训练一次，结果在返回菜单时输出"""
+    predict_conn, _ = fresh_mock_db()
+    shard_map = MagicMock()
+    shard_map.shard_for.return_value = "shard-a"
+    shard_map.getconn.return_value = predict_conn
+    monkeypatch.setattr(task, "get_shard_map", lambda: shard_map)
+    monkeypatch.setattr(task, "has_enough_data", lambda conn, tenant_id, log: True)
+    release = threading.Event()
+    trained = []
+
+    def train(conn, tenant_id, log):
+        trained.append(tenant_id)
+        if tenant_id == "team-b":
+            release.wait(timeout=5)  # 占住后台线程，使 team-a 的请求排队
+        log("模型训练完成，准确率: 80.0%")
+        return "model", "scaler"
+
+    monkeypatch.setattr(task, "train_model", train)
+    monkeypatch.setattr(
+        task, "_score_task",
+        lambda conn, model, scaler, task_id, tenant_id, log: task_id / 100,
+    )
+    predict_conn.autocommit = False
+
+    first = task.submit_prediction(41, "team-b")
+    future = task.submit_prediction(42, "team-a")
+    assert task.submit_prediction(44, "team-a") is future
+    release.set()
+    first.result(timeout=5)
+    future.result(timeout=5)
+    assert trained == ["team-b", "team-a"]
+    # 后台线程不直接输出
+    assert capsys.readouterr().out == ""
+
+    # 其他异常（如读取快照文件失败）也会被记录下来，而不是在线程中丢失
+    def fail(conn, tenant_id, log):
+        raise OSError("快照文件损坏")
+
+    monkeypatch.setattr(task, "train_model", fail)
+    task.submit_prediction(43, "team-a").result(timeout=5)
+    task.shutdown_predictions()
+
+    task.report_finished_predictions()
+    captured = capsys.readouterr()
+    assert "模型训练完成，准确率: 80.0%" in captured.out
+    assert "预测任务 42 按时完成的概率: 42.0%" in captured.out
+    assert "预测任务 44 按时完成的概率: 44.0%" in captured.out
+    assert "后台预测任务 43 失败: 快照文件损坏" in captured.out
+    assert shard_map.shard_for.call_args[0][0] == "team-a"
+    assert shard_map.putconn.call_args_list == [(("shard-a", predict_conn),)] * 3
+    # 归还连接池前恢复了连接原来的自动提交设置
+    assert predict_conn.autocommit is False
+
+
+def test_task_graph_schedule_and_incremental_update():
+    """依赖图：关键路径、最早/最晚完成时间，以及增量更新与全量重算一致"""
+    inf = float("inf")
+    # 1 -> 2 -> 4, 1 -> 3 -> 4（4 依赖 2 和 3）
+    ids = [1, 2, 3, 4]
+    durations = [2.0, 5.0, 1.0, 3.0]
+    due = [inf, inf, 4.0, 12.0]
+    dependents, dependencies = [2, 3, 4, 4], [1, 1, 2, 3]
+    graph = task.TaskGraph(ids, durations, due, dependents, dependencies, now=0.0)
+
+    assert list(graph.topological_order()[:1]) == [1]
+    assert list(graph.earliest_finish) == [2.0, 7.0, 3.0, 10.0]
+    assert list(graph.latest_finish) == [3.0, 9.0, 4.0, 12.0]
+    assert graph.critical_path() == [1, 2, 4]
+
+    graph.update_task(3, duration=8.0)
+    graph.update_task(1, due=1.0)
+    fresh = task.TaskGraph(
+        ids, [2.0, 5.0, 8.0, 3.0], [1.0, inf, 4.0, 12.0],
+        dependents, dependencies, now=0.0,
+    )
+    assert np.array_equal(graph.earliest_finish, fresh.earliest_finish)
+    assert np.array_equal(graph.latest_finish, fresh.latest_finish)
+    assert graph.critical_path() == [1, 3, 4]
+
+    # 时间推移后按新的当前时间重新排期
+    graph.set_now(5.0)
+    fresh = task.TaskGraph(
+        ids, [2.0, 5.0, 8.0, 3.0], [1.0, inf, 4.0, 12.0],
+        dependents, dependencies, now=5.0,
+    )
+    assert np.array_equal(graph.earliest_finish, fresh.earliest_finish)
+    assert np.array_equal(graph.latest_finish, fresh.latest_finish)
+
+    with pytest.raises(ValueError):
+        task.TaskGraph([1, 2], [1.0, 1.0], [inf, inf], [1, 2], [2, 1], now=0.0)
+
+
+def test_schedule_cache_follows_other_sessions(pg_conn):
+    """缓存的依赖图：本会话的修改增量更新，其他会话修改任务或依赖后重新加载"""
+    dsn = os.getenv("TEST_DATABASE_DSN")
+    cursor = pg_conn.cursor()
+    cursor.execute(
+        "INSERT INTO tasks (title, estimated_hours, tenant_id) VALUES "
+        "('a', 2, 't1'), ('b', 3, 't1'), ('c', 1, 't1') RETURNING id"
+    )
+    a, b, c = (row[0] for row in cursor.fetchall())
+    cursor.execute(
+        "INSERT INTO task_dependencies (task_id, depends_on_id) VALUES (%s, %s)", (b, a)
+    )
+    pg_conn.commit()
+
+    graph = task.load_task_graph(pg_conn, "t1")
+    assert graph.critical_path() == [a, b]
+    assert task.current_task_graph(pg_conn, graph, "t1") is graph
+
+    # 本会话修改任务后增量更新，标记随之更新，不必重建
+    cursor.execute("UPDATE tasks SET estimated_hours = 10 WHERE id = %s", (c,))
+    pg_conn.commit()
+    assert task.refresh_task_schedule(pg_conn, graph, c, "t1")
+    assert task.current_task_graph(pg_conn, graph, "t1") is graph
+    assert graph.critical_path() == [c]
+
+    other = psycopg2.connect(dsn)
+    try:
+        other_cursor = other.cursor()
+        other_cursor.execute(
+            "INSERT INTO task_dependencies (task_id, depends_on_id) VALUES (%s, %s)", (c, b)
+        )
+        other.commit()
+        reloaded = task.current_task_graph(pg_conn, graph, "t1")
+        assert reloaded is not graph
+        assert reloaded.critical_path() == [a, b, c]
+
+        other_cursor.execute("UPDATE tasks SET estimated_hours = 1 WHERE id = %s", (a,))
+        other.commit()
+        # 其他会话的修改混在其中时不能只增量更新本会话的任务
+        cursor.execute("UPDATE tasks SET estimated_hours = 4 WHERE id = %s", (b,))
+        pg_conn.commit()
+        assert not task.refresh_task_schedule(pg_conn, reloaded, b, "t1")
+        assert task.current_task_graph(pg_conn, reloaded, "t1") is not reloaded
+    finally:
+        other.close()
+
+
+@pytest.mark.parametrize("hours", ["abc", "-2"])
+def test_add_task_rejects_invalid_hours(fresh_mock_db, monkeypatch, capsys, hours):
+    """预估工时不是数字或为负数时提示错误，不插入任务"""
+    mock_conn, mock_cursor = fresh_mock_db()
+    answers = iter(["标题", "", "", "", hours])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+
+    task.add_task(mock_conn)
+    assert "无效的工时!" in capsys.readouterr().out
+    mock_cursor.execute.assert_not_called()
+
+
+def test_add_dependency_rejects_cycle(fresh_mock_db, monkeypatch, capsys):
+    """添加依赖时检测到环则回滚，不插入"""
+    mock_conn, mock_cursor = fresh_mock_db()
+    mock_cursor.fetchone.side_effect = [(2,), (1,)]  # 两个任务都属于该租户；存在环
+    answers = iter(["1", "2"])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+
+    assert task.add_dependency(mock_conn) is False
+    assert "循环依赖" in capsys.readouterr().out
+    assert "WITH RECURSIVE" in mock_cursor.execute.call_args[0][0]
+    mock_conn.rollback.assert_called_once()
+    mock_conn.commit.assert_not_called()
+
+
+def test_report_single_round_trip(fresh_mock_db, capsys):
+    """统计报表：缓存读取、聚合和窗口计算在一条语句中完成，并提交缓存"""
+    mock_conn, mock_cursor = fresh_mock_db()
+    mock_cursor.fetchall.return_value = [
+        (datetime(2024, 1, 1).date(), 4, 0.5, 0.5),
+        (datetime(2024, 1, 8).date(), 2, None, 0.5),
+    ]
+
+    task.run_report(mock_conn, '2')
+
+    mock_cursor.execute.assert_called_once()
+    sql = mock_cursor.execute.call_args[0][0]
+    assert "report_weekly_stats" in sql
+    assert "OVER w" in sql
+    mock_conn.commit.assert_called_once()
+
+    captured = capsys.readouterr()
+    assert "每周按时完成率" in captured.out
+    assert "2024-01-01 | 4 | 50.0% | 50.0%" in captured.out
+    assert "2024-01-08 | 2 | - | 50.0%" in captured.out
+
+
+def test_report_cache_follows_task_changes(pg_conn, capsys):
+    """真实数据库：缓存周内的任务被延迟完成、补录到更早的周后，报表结果与不用缓存时一致"""
+    cursor = pg_conn.cursor()
+    weekly_sql = (
+        task.WEEKLY_STATS_CTE
+        + f"SELECT {task.WEEKLY_STATS_COLUMNS} FROM weekly_stats ORDER BY 1, 2"
+    )
+
+    def weekly_stats():
+        """经过缓存的周聚合，以及清空缓存后直接从 tasks 聚合的结果"""
+        cursor.execute(weekly_sql, {"tenant": task.DEFAULT_TENANT})
+        cached = cursor.fetchall()
+        pg_conn.commit()
+        cursor.execute("SAVEPOINT uncached")
+        cursor.execute("DELETE FROM report_weekly_stats")
+        cursor.execute(weekly_sql, {"tenant": task.DEFAULT_TENANT})
+        uncached = cursor.fetchall()
+        cursor.execute("ROLLBACK TO SAVEPOINT uncached")
+        pg_conn.commit()
+        return cached, uncached
+
+    cursor.execute("""
+        INSERT INTO tasks (title, priority, due_date, created_at, is_completed, completed_at)
+        VALUES ('按时', 2, now() - interval '21 days', now() - interval '30 days',
+                TRUE, now() - interval '22 days'),
+               ('未完成', 2, now() - interval '21 days', now() - interval '30 days',
+                FALSE, NULL)
+        RETURNING id
+    """)
+    open_id = cursor.fetchall()[1][0]
+    pg_conn.commit()
+
+    task.run_report(pg_conn, '3')
+    assert "暂无数据!" in capsys.readouterr().out
+    cursor.execute("SELECT COUNT(*) FROM report_weekly_stats")
+    assert cursor.fetchone()[0] > 0
+
+    # 缓存周内的任务延迟完成：逾期报表应包含它
+    cursor.execute(
+        "UPDATE tasks SET is_completed = TRUE, completed_at = now() WHERE id = %s", (open_id,)
+    )
+    pg_conn.commit()
+    task.run_report(pg_conn, '3')
+    assert "| 1 |" in capsys.readouterr().out
+    cached, uncached = weekly_stats()
+    assert cached == uncached
+
+    # 补录到比所有缓存周更早的周
+    cursor.execute("""
+        INSERT INTO tasks (title, priority, due_date, created_at)
+        VALUES ('补录', 4, now() - interval '40 days', now() - interval '50 days')
+    """)
+    pg_conn.commit()
+    cached, uncached = weekly_stats()
+    assert cached == uncached
+    assert sum(row[2] for row in cached) == 3
+
+    # 只修改标题等与统计无关的列不会使缓存失效
+    cursor.execute("SELECT COUNT(*) FROM report_weekly_stats")
+    cached_rows = cursor.fetchone()[0]
+    cursor.execute("UPDATE tasks SET title = '改名', estimated_hours = 2")
+    cursor.execute("SELECT COUNT(*) FROM report_weekly_stats")
+    assert cursor.fetchone()[0] == cached_rows > 0
+    pg_conn.rollback()
+
+
+def test_shard_map_consistent_hashing_and_write_guard():
+    """分片路由：一致性哈希稳定，新增分片只迁移少量租户；迁移中的租户拒绝写入"""
+    tenants = [f"team-{i}" for i in range(1000)]
+    two = task.ShardMap({"a": "dsn-a", "b": "dsn-b"})
+    three = task.ShardMap({"a": "dsn-a", "b": "dsn-b", "c": "dsn-c"})
+
+    placement = {t: two.shard_for(t) for t in tenants}
+    assert placement == {t: two.shard_for(t) for t in tenants}
+    assert set(placement.values()) == {"a", "b"}
+    moved = [t for t in tenants if three.shard_for(t) != placement[t]]
+    assert all(three.shard_for(t) == "c" for t in moved)
+    assert len(moved) < len(tenants) / 2
+
+    # 无租户目录时不做写保护
+    assert two.begin_write("team-1", "a") is True
+
+    directory = MagicMock()
+    cursor = directory.cursor.return_value
+    shard_map = task.ShardMap({"a": "dsn-a", "b": "dsn-b"}, directory)
+
+    cursor.fetchone.return_value = ("a", False)
+    assert shard_map.begin_write("team-1", "a") is True
+    assert "FOR SHARE" in cursor.execute.call_args[0][0]
+    shard_map.end_write()
+    directory.commit.assert_called_once()
+
+    cursor.fetchone.return_value = ("a", True)  # 迁移中
+    assert shard_map.begin_write("team-1", "a") is False
+    cursor.fetchone.return_value = ("b", False)  # 已迁走
+    assert shard_map.begin_write("team-1", "a") is False
+    assert directory.rollback.call_count == 2
+
+    # 读操作前重新读取目录，发现租户已迁走
+    cursor.fetchone.return_value = ("b",)
+    assert shard_map.current_shard("team-1") == "b"
+    assert "FOR SHARE" not in cursor.execute.call_args[0][0]
+
+
+def test_copy_tenant_keeps_task_ids(fresh_mock_db, monkeypatch):
+    """迁移租户：任务、依赖和删除记录按原任务ID复制到目标分片"""
+    source, source_cursor = fresh_mock_db()
+    target, _ = fresh_mock_db()
+    created = datetime(2024, 1, 1)
+    source_cursor.fetchall.side_effect = [
+        [(7, "a", None, 3, False, None, created, None, 2.0),
+         (9, "b", None, 3, False, None, created, None, None)],
+        [(9, 7)],
+        [(8, "team-1", created)],
+    ]
+    inserted = {}
+    monkeypatch.setattr(
+        task, "execute_values",
+        lambda cursor, sql, rows: inserted.setdefault(sql.split()[2], rows),
+    )
+
+    assert task._copy_tenant(source, target, "team-1") == 2
+    assert [row[:2] for row in inserted["tasks"]] == [(7, "team-1"), (9, "team-1")]
+    assert inserted["task_dependencies"] == [(9, 7)]
+    assert inserted["task_deletions"] == [(8, "team-1", created)]
+
+
+def test_move_tenant_resumes_and_aborts(monkeypatch, capsys):
+    """迁移中断后：相同参数继续迁移，换目标被拒绝；未切换目录前可以中止"""
+    shard_map = MagicMock(shard_dsns={"a": "dsn-a", "b": "dsn-b"})
+    shard_map.shard_for.return_value = "a"
+    shard_map.update_placement.return_value = True
+    copies, cleanups = [], []
+    monkeypatch.setattr(
+        task, "_copy_between_shards",
+        lambda sm, source, target, tenant: copies.append((source, target)) or 2,
+    )
+    monkeypatch.setattr(
+        task, "_cleanup_shard",
+        lambda sm, shard, tenant: cleanups.append(shard) or True,
+    )
+
+    shard_map.move_state.return_value = ("a", True, None, "b")
+    assert task.move_tenant(shard_map, "team-1", "a") is False
+    assert "正在迁移到分片 b" in capsys.readouterr().out
+    assert task.move_tenant(shard_map, "team-1", "b") is True
+    assert copies == [("a", "b")] and cleanups == ["a"]
+    # 先切换目录并记录待清理的源分片，清理完成后再清除
+    assert shard_map.update_placement.call_args_list == [
+        (("team-1",), {"shard": "b", "move_source": "a"}),
+        (("team-1",),),
+    ]
+
+    # 已切换目录、源分片未清理完：重新执行只做清理，不能中止
+    shard_map.move_state.return_value = ("b", False, "a", None)
+    assert task.abort_move(shard_map, "team-1") is False
+    assert task.move_tenant(shard_map, "team-1", "b") is True
+    assert copies == [("a", "b")] and cleanups == ["a", "a"]
+
+    cleanups.clear()
+    shard_map.move_state.return_value = ("a", True, None, "b")
+    assert task.abort_move(shard_map, "team-1") is True
+    assert cleanups == ["b"]
+    assert shard_map.update_placement.call_args == (("team-1",),)
+
+
+def test_write_guard_only_wraps_sql(fresh_mock_db, monkeypatch):
+    """写保护只包住SQL：等待用户输入时不持有租户目录上的锁"""
+    mock_conn, mock_cursor = fresh_mock_db()
+    monkeypatch.setattr(task, "submit_prediction", lambda task_id, tenant_id: None)
+    shard_map = task.ShardMap({"a": "dsn-a"}, MagicMock())
+    shard_map.directory.cursor.return_value.fetchone.return_value = ("a", False)
+    held = []
+    locked = [False]
+
+    @contextlib.contextmanager
+    def guard():
+        with shard_map.write_guard("team-1", "a") as allowed:
+            locked[0] = True
+            yield allowed
+            locked[0] = False
+
+    answers = {"请输入任务标题: ": "标题"}
+    monkeypatch.setattr(
+        'builtins.input', lambda prompt: held.append(locked[0]) or answers.get(prompt, "")
+    )
+    mock_cursor.execute.side_effect = lambda *args: held.append(locked[0])
+    task.add_task(mock_conn, "team-1", guard=guard)
+
+    assert held == [False] * 5 + [True]
+    shard_map.directory.commit.assert_called_once()
+
+
 if __name__ == "__main__":
     pytest.main(["-s", __file__])  # 使用-s参数显示打印内容
\ No newline at end of file